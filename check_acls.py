@@ -1,14 +1,36 @@
 #!/usr/bin/python
 
-import math
+import argparse
+import bisect
+import collections
+import multiprocessing.pool
 import netaddr
 import os
+import pickle
 import sys
+import threading
+import time
 
 from neutronclient.v2_0 import client as clientv20
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 client = None
+# merge_ranges() switches to numpy from this many IPv4 ranges
+NUMPY_MIN_RANGES = 1000
+# accesslists per page of the bulk listing
+ACL_PAGE_SIZE = 1000
+# per tenant queries in flight and API calls per second across them
+TENANT_WORKERS = 8
+API_RATE = 20.0
+# bumped whenever the AclIndex layout changes
+ACL_INDEX_VERSION = 1
+# redundant acls listed by overlap_report()
+OVERLAP_TOP = 20
 
 
 def get_client():
@@ -25,87 +47,430 @@ def get_client():
     return client
 
 
-def _convert_to_cidr(first, last):
-    num = math.log((last - first + 1), 2)
-    num_int = int(num)
-    _first = -1
-    _last = -1
-    if num_int != num:
-        tmp = first + int(math.pow(2, num_int)) - 1
-        _last = last
-        last = tmp
-        _first = tmp + 1
-    prelen = 32 - num_int
-    ip = netaddr.IPAddress(first)
-    cidr = str(ip) + '/' + str(prelen)
-    if _first > 0 and _last > 0:
-        cidr += ',' + _convert_to_cidr(_first, _last)
-    return cidr
+def range_to_cidrs(first, last, version=4):
+    """Split [first, last] into the fewest (network, prefixlen) blocks.
 
+    Pure integer arithmetic: each block is the largest power of two that
+    is aligned at first and still fits in the range.
+    """
+    bits = 32 if version == 4 else 128
+    cidrs = []
+    while first <= last:
+        # largest block aligned at first
+        size = (first & -first) or (1 << bits)
+        # shrink it to fit in the range
+        remain = last - first + 1
+        while size > remain:
+            size >>= 1
+        cidrs.append((first, bits - size.bit_length() + 1))
+        first += size
+    return cidrs
 
-def check_cidrs(cidrs):
-    def _compare_cidr(c1, c2):
-        if c1[0] != c2[0]:
-            return c1[0] - c2[0]
-        else:
-            return c2[1] - c1[1]
 
-    tmp_list = []
-    for c in cidrs:
-        net = netaddr.IPNetwork(c)
-        tmp_list.append((net.first, net.last))
-    cidr_list = sorted(tmp_list, cmp=_compare_cidr)
-    cur_first = -2
-    cur_last = -2
-    effective_cidr = []
-    overlapped_cidr = []
-    for first, last in cidr_list:
-        if (cur_last + 1) < first:
-            if cur_first <= cur_last and cur_first > 0:
-                effective_cidr.append((cur_first, cur_last))
+def _convert_to_cidr(first, last, version=4):
+    return ','.join('%s/%d' % (netaddr.IPAddress(net, version), prefixlen)
+                    for net, prefixlen in range_to_cidrs(first, last,
+                                                         version))
+
+
+def _merge_ranges_numpy(firsts, lasts):
+    order = numpy.lexsort((-lasts, firsts))
+    firsts = firsts[order]
+    lasts = lasts[order]
+    # highest address covered by the ranges before each one
+    covered = numpy.maximum.accumulate(lasts)
+    prev = numpy.empty_like(covered)
+    prev[0] = -2
+    prev[1:] = covered[:-1]
+    starts = numpy.flatnonzero(firsts > prev + 1)
+    ends = numpy.append(starts[1:], len(firsts)) - 1
+    effective = list(zip(firsts[starts].tolist(), covered[ends].tolist()))
+    overlap = numpy.flatnonzero(firsts <= prev)
+    overlapped = list(zip(firsts[overlap].tolist(),
+                          numpy.minimum(lasts[overlap],
+                                        prev[overlap]).tolist()))
+    return list(zip(firsts.tolist(), lasts.tolist())), effective, overlapped
+
+
+def merge_ranges(ranges, version=4):
+    """Sort and sweep (first, last) ranges of one IP version.
+
+    Returns (sorted ranges, effective ranges with overlapping and adjacent
+    ranges merged, overlapped parts). Large IPv4 sets are swept with numpy
+    when it is installed.
+    """
+    if numpy is not None and version == 4 and len(ranges) >= NUMPY_MIN_RANGES:
+        firsts = numpy.fromiter((r[0] for r in ranges), numpy.int64,
+                                len(ranges))
+        lasts = numpy.fromiter((r[1] for r in ranges), numpy.int64,
+                               len(ranges))
+        return _merge_ranges_numpy(firsts, lasts)
+    range_list = sorted(ranges, key=lambda r: (r[0], -r[1]))
+    effective = []
+    overlapped = []
+    cur_first = None
+    cur_last = None
+    for first, last in range_list:
+        if cur_first is None or cur_last + 1 < first:
+            if cur_first is not None:
+                effective.append((cur_first, cur_last))
             cur_first = first
             cur_last = last
-        elif (cur_last + 1) == first:
+        elif cur_last + 1 == first:
             # continuous
             cur_last = last
         else:  # overlapped
-            if cur_last < last:
-                _last = cur_last
-                cur_last = last
-            else:
-                _last = last
-            overlapped_cidr.append((first, _last))
-    if cur_last >= cur_first and cur_first >= 0:
-        effective_cidr.append((cur_first, cur_last))
-    print("setted acls: %s" % ','.join([_convert_to_cidr(first, last)
-                                       for first, last in cidr_list]))
-    if cidr_list != effective_cidr:
-        print('effective acls: %s'
-              % ','.join([_convert_to_cidr(first, last)
-                         for first, last in effective_cidr]))
-    if overlapped_cidr:
-        print('overlapped cidrs: %s'
-              % ','.join([_convert_to_cidr(first, last)
-                         for first, last in overlapped_cidr]))
+            overlapped.append((first, min(cur_last, last)))
+            cur_last = max(cur_last, last)
+    if cur_first is not None:
+        effective.append((cur_first, cur_last))
+    return range_list, effective, overlapped
 
 
-def check_tenant_acls(tenant_id):
-    neutron = get_client()
+def check_cidrs(cidrs):
+    ranges = {4: [], 6: []}
+    for c in cidrs:
+        net = netaddr.IPNetwork(c)
+        ranges[net.version].append((net.first, net.last))
+    setted = []
+    effective = []
+    overlapped = []
+    changed = False
+    for version in (4, 6):
+        if not ranges[version]:
+            continue
+        cidr_list, effective_cidr, overlapped_cidr = merge_ranges(
+            ranges[version], version)
+        changed = changed or cidr_list != effective_cidr
+        setted.extend(_convert_to_cidr(first, last, version)
+                      for first, last in cidr_list)
+        effective.extend(_convert_to_cidr(first, last, version)
+                         for first, last in effective_cidr)
+        overlapped.extend(_convert_to_cidr(first, last, version)
+                          for first, last in overlapped_cidr)
+    print("setted acls: %s" % ','.join(setted))
+    if changed:
+        print('effective acls: %s' % ','.join(effective))
+    if overlapped:
+        print('overlapped cidrs: %s' % ','.join(overlapped))
+
+
+class RateLimitedClient(object):
+    """Share one neutron client across threads at a bounded call rate."""
+
+    def __init__(self, neutron, rate=API_RATE):
+        self.neutron = neutron
+        self.interval = 1.0 / rate if rate > 0 else 0
+        self.lock = threading.Lock()
+        self.next_call = 0
+
+    def _wait(self):
+        with self.lock:
+            now = time.time()
+            delay = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+    def list_accesslists(self, **search_opts):
+        self._wait()
+        return self.neutron.list_accesslists(**search_opts)
+
+
+def get_tenant_acls(tenant_id, neutron=None):
+    neutron = neutron or get_client()
     search_opts = {'tenant_id': tenant_id}
     acls = neutron.list_accesslists(**search_opts).get('accesslists')
-    if not acls:
+    return set([acl['destination'] for acl in acls or []])
+
+
+def get_all_acls(neutron=None, page_size=ACL_PAGE_SIZE):
+    """Fetch every accesslist in one paginated listing.
+
+    Returns {tenant_id: set of destination cidrs}.
+    """
+    neutron = neutron or get_client()
+    acls = neutron.list_accesslists(
+        limit=page_size, fields=['tenant_id', 'destination'])
+    tenant_cidrs = collections.defaultdict(set)
+    for acl in acls.get('accesslists') or []:
+        tenant_cidrs[acl['tenant_id']].add(acl['destination'])
+    return tenant_cidrs
+
+
+def check_tenant_acls(tenant_id):
+    cidrs = get_tenant_acls(tenant_id)
+    if not cidrs:
         return
-    cidrs = set([acl['destination'] for acl in acls])
     check_cidrs(cidrs)
 
 
-def check_tenants(list_file):
+def read_tenants(list_file):
     with open(list_file) as f:
-        for tenant in f.readlines():
-            tenant = tenant.rstrip('\n')
-            print("tenant %s" % tenant)
-            check_tenant_acls(tenant)
-            print('\n')
+        return [line.strip() for line in f if line.strip()]
+
+
+def iter_tenant_acls(tenants, workers=TENANT_WORKERS, rate=API_RATE):
+    """Yield (tenant, cidrs) in order, querying tenants concurrently."""
+    neutron = RateLimitedClient(get_client(), rate)
+
+    def _get(tenant):
+        try:
+            return tenant, get_tenant_acls(tenant, neutron)
+        except Exception as e:
+            return tenant, e
+
+    pool = multiprocessing.pool.ThreadPool(
+        min(workers, len(tenants)) or 1)
+    try:
+        for result in pool.imap(_get, tenants):
+            yield result
+    finally:
+        pool.close()
+
+
+def check_tenants(list_file=None, bulk=False, workers=TENANT_WORKERS,
+                  rate=API_RATE):
+    """Check the acls of the tenants in list_file.
+
+    bulk fetches all accesslists at once, without list_file every tenant
+    owning one is checked. Otherwise tenants are queried by a pool of
+    workers sharing a rate limited client.
+    """
+    if bulk:
+        tenant_cidrs = get_all_acls()
+        tenants = (read_tenants(list_file) if list_file
+                   else sorted(tenant_cidrs))
+        results = ((tenant, tenant_cidrs.get(tenant)) for tenant in tenants)
+    else:
+        results = iter_tenant_acls(read_tenants(list_file), workers, rate)
+    for tenant, cidrs in results:
+        print("tenant %s" % tenant)
+        if isinstance(cidrs, Exception):
+            print("Error: %s" % cidrs)
+        elif cidrs:
+            check_cidrs(cidrs)
+        print('\n')
+
+
+class AclIndex(object):
+    """Which tenants' accesslists cover an address or a range.
+
+    CIDR blocks are either nested or disjoint, so the distinct networks
+    form a tree in which each network points at the smallest one holding
+    it. The address space of each IP version is cut into segments at
+    every network boundary, and segments are kept sorted by first address
+    with the innermost network covering them. A lookup is one bisect and
+    a walk up the tree.
+    """
+
+    def __init__(self):
+        # [(tenant, cidr)]
+        self.acls = []
+        # per network: indexes into acls and the enclosing network or -1
+        self.net_acls = []
+        self.parents = []
+        # {version: ([segment first address], [innermost network or -1])}
+        self.segments = {}
+
+    @classmethod
+    def build(cls, tenant_cidrs):
+        """Build the index from {tenant_id: cidrs}."""
+        index = cls()
+        nets = {4: {}, 6: {}}
+        for tenant in sorted(tenant_cidrs):
+            for cidr in sorted(tenant_cidrs[tenant]):
+                net = netaddr.IPNetwork(cidr)
+                nets[net.version].setdefault(
+                    (net.first, net.last), []).append(len(index.acls))
+                index.acls.append((tenant, cidr))
+        for version in (4, 6):
+            starts = [0]
+            inner = [-1]
+
+            def _segment(pos, net):
+                if starts[-1] == pos:
+                    inner[-1] = net
+                else:
+                    starts.append(pos)
+                    inner.append(net)
+
+            # open networks, innermost last
+            stack = []
+            for first, last in sorted(nets[version],
+                                      key=lambda r: (r[0], -r[1])):
+                while stack and stack[-1][1] < first:
+                    _, end = stack.pop()
+                    _segment(end + 1, stack[-1][0] if stack else -1)
+                net = len(index.net_acls)
+                index.net_acls.append(tuple(nets[version][(first, last)]))
+                index.parents.append(stack[-1][0] if stack else -1)
+                stack.append((net, last))
+                _segment(first, net)
+            while stack:
+                _, end = stack.pop()
+                _segment(end + 1, stack[-1][0] if stack else -1)
+            index.segments[version] = (starts, inner)
+        return index
+
+    def _collect(self, nets):
+        acls = set()
+        seen = set()
+        for net in nets:
+            while net >= 0 and net not in seen:
+                seen.add(net)
+                acls.update(self.net_acls[net])
+                net = self.parents[net]
+        return [self.acls[acl] for acl in sorted(acls)]
+
+    def lookup(self, addr):
+        """Return the (tenant, cidr) acls covering the address addr."""
+        addr = netaddr.IPAddress(addr)
+        starts, inner = self.segments[addr.version]
+        return self._collect(
+            [inner[bisect.bisect_right(starts, int(addr)) - 1]])
+
+    def lookup_range(self, cidr):
+        """Return the (tenant, cidr) acls overlapping cidr or first-last."""
+        if '-' in cidr:
+            first, last = cidr.split('-', 1)
+            net = netaddr.IPRange(first.strip(), last.strip())
+        else:
+            net = netaddr.IPNetwork(cidr)
+        starts, inner = self.segments[net.version]
+        first = bisect.bisect_right(starts, net.first) - 1
+        last = bisect.bisect_right(starts, net.last)
+        return self._collect(set(inner[first:last]))
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            pickle.dump({'version': ACL_INDEX_VERSION, 'acls': self.acls,
+                         'net_acls': self.net_acls, 'parents': self.parents,
+                         'segments': self.segments},
+                        f, pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, path):
+        """Load a saved index, None if missing or of another version."""
+        try:
+            with open(path, 'rb') as f:
+                data = pickle.load(f)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            return None
+        if data.get('version') != ACL_INDEX_VERSION:
+            return None
+        index = cls()
+        index.acls = data['acls']
+        index.net_acls = data['net_acls']
+        index.parents = data['parents']
+        index.segments = data['segments']
+        return index
+
+
+def query_acls(queries, index_file=None, rebuild=False):
+    """Print the acls covering each address, cidr or first-last range.
+
+    The index is loaded from index_file when present, otherwise built from
+    all accesslists and saved there.
+    """
+    index = None
+    if index_file and not rebuild:
+        index = AclIndex.load(index_file)
+    if index is None:
+        index = AclIndex.build(get_all_acls())
+        if index_file:
+            index.save(index_file)
+    for query in queries:
+        if '/' in query or '-' in query:
+            acls = index.lookup_range(query)
+        else:
+            acls = index.lookup(query)
+        print("%s: %d acls" % (query, len(acls)))
+        for tenant, cidr in acls:
+            print("  %s %s" % (tenant, cidr))
+
+
+def find_overlaps(tenant_cidrs):
+    """Sweep all tenants' acls once, sorted by address.
+
+    Returns (shared, space, redundant): the (version, first, last,
+    tenants) ranges covered by more than one tenant, {tenant: addresses
+    covered} and the (addresses, tenant, cidr) acls already covered by a
+    bigger acl of the same tenant.
+    """
+    shared = []
+    space = collections.Counter()
+    redundant = []
+    nets = {4: [], 6: []}
+    for tenant, cidrs in tenant_cidrs.items():
+        for cidr in cidrs:
+            net = netaddr.IPNetwork(cidr)
+            nets[net.version].append((net.first, -net.last, tenant, cidr))
+    for version in (4, 6):
+        nets[version].sort()
+        events = []
+        # highest address covered so far per tenant
+        covered = {}
+        for first, last, tenant, cidr in nets[version]:
+            last = -last
+            if covered.get(tenant, -1) >= last:
+                redundant.append((last - first + 1, tenant, cidr))
+                continue
+            covered[tenant] = max(covered.get(tenant, -1), last)
+            events.append((first, 1, tenant))
+            events.append((last + 1, -1, tenant))
+        events.sort()
+        # acls open per tenant and where the tenant's coverage started
+        counts = {}
+        starts = {}
+        current = None
+        i = 0
+        n = len(events)
+        while i < n:
+            pos = events[i][0]
+            changed = False
+            while i < n and events[i][0] == pos:
+                _, step, tenant = events[i]
+                count = counts.get(tenant, 0) + step
+                if count:
+                    counts[tenant] = count
+                    if count == 1 and step > 0:
+                        starts[tenant] = pos
+                        changed = True
+                else:
+                    del counts[tenant]
+                    space[tenant] += pos - starts.pop(tenant)
+                    changed = True
+                i += 1
+            if not changed:
+                continue
+            tenants = sorted(counts)
+            if current and current[1] == tenants:
+                # an acl ended where another of the same tenant started
+                continue
+            if current:
+                shared.append((version, current[0], pos - 1, current[1]))
+                current = None
+            if len(counts) > 1:
+                current = (pos, tenants)
+    redundant.sort(reverse=True)
+    return shared, space, redundant
+
+
+def overlap_report(tenant_cidrs, top=OVERLAP_TOP):
+    shared, space, redundant = find_overlaps(tenant_cidrs)
+    print("shared ranges: %d" % len(shared))
+    for version, first, last, tenants in shared:
+        print("  %s (%d addresses): %s"
+              % (_convert_to_cidr(first, last, version), last - first + 1,
+                 ','.join(tenants)))
+    print("\naddresses covered per tenant:")
+    for tenant, addresses in sorted(space.items(),
+                                    key=lambda t: (-t[1], t[0])):
+        print("  %s %d" % (tenant, addresses))
+    print("\nlargest redundant acls: %d" % len(redundant))
+    for addresses, tenant, cidr in redundant[:top]:
+        print("  %s %s (%d addresses)" % (tenant, cidr, addresses))
 
 
 def test_cidrs():
@@ -117,9 +482,46 @@ def test_cidrs():
 
 
 if __name__ == '__main__':
-    if len(sys.argv) != 2:
-        print("Usege: check_acls.py tenant_list")
-        sys.exit(1)
-    tenant_list = sys.argv[1]
-    check_tenants(tenant_list)
+    parser = argparse.ArgumentParser(
+        description='Check the accesslists of tenants for overlaps')
+    parser.add_argument('-b', '--bulk', action='store_true',
+                        help='fetch all accesslists in one paginated listing '
+                        'instead of one query per tenant')
+    parser.add_argument('-j', '--workers', type=int, default=TENANT_WORKERS,
+                        help='concurrent per tenant queries')
+    parser.add_argument('-q', '--rate', type=float, default=API_RATE,
+                        help='API calls per second across the workers, '
+                        '0 for no limit')
+    parser.add_argument('-l', '--lookup', action='append',
+                        metavar='ADDR',
+                        help='print the tenants whose acls cover ADDR, a '
+                        'cidr or a first-last range; may be repeated')
+    parser.add_argument('-I', '--index', metavar='INDEX_FILE',
+                        help='load the lookup index from INDEX_FILE, build '
+                        'and save it there when missing')
+    parser.add_argument('-u', '--update-index', action='store_true',
+                        help='rebuild INDEX_FILE from all accesslists')
+    parser.add_argument('-o', '--overlaps', action='store_true',
+                        help='report ranges shared by several tenants, the '
+                        'addresses covered per tenant and redundant acls, '
+                        'from one bulk listing')
+    parser.add_argument('-n', '--top', type=int, default=OVERLAP_TOP,
+                        help='redundant acls listed with --overlaps')
+    parser.add_argument('tenant_list', nargs='?',
+                        help='file with one tenant id per line, optional '
+                        'with --bulk')
+    args = parser.parse_args()
+    if args.lookup or args.update_index:
+        query_acls(args.lookup or [], args.index, args.update_index)
+        sys.exit(0)
+    if args.overlaps:
+        tenant_cidrs = get_all_acls()
+        if args.tenant_list:
+            tenant_cidrs = dict((tenant, tenant_cidrs.get(tenant, set()))
+                                for tenant in read_tenants(args.tenant_list))
+        overlap_report(tenant_cidrs, args.top)
+        sys.exit(0)
+    if not args.tenant_list and not args.bulk:
+        parser.error('tenant_list is required without --bulk')
+    check_tenants(args.tenant_list, args.bulk, args.workers, args.rate)
 #    test_cidrs()
@@ -1,14 +1,38 @@
 #!/usr/bin/python
 
 import collections
+import heapq
+import math
+import multiprocessing.pool
 import os
+import random
 import sys
+import time
 import uuid
 
+from neutronclient.common import exceptions
 from neutronclient.v2_0 import client as clientv20
 
 
 client = None
+# per router port queries in flight
+ROUTER_WORKERS = 16
+# attempts after the first one, backoff bounds and time budget per item
+RETRY_LIMIT = 5
+RETRY_BACKOFF = 0.5
+RETRY_BACKOFF_MAX = 30
+RETRY_DEADLINE = 120
+# default size of the synthetic cloud of router-reschedule-benchmark
+BENCHMARK_ROUTERS = 100000
+BENCHMARK_AGENTS = 300
+# allowed deviation of agent load and masters from the mean when
+# rebalancing, as a fraction of the mean
+REBALANCE_TOLERANCE = 0.1
+# file of "<agent id or host> <capacity>" lines weighting the L3 agents,
+# agents not listed use configurations['capacity'] or the default
+AGENT_CAPACITY_FILE = os.environ.get('L3_AGENT_CAPACITY_FILE')
+DEFAULT_AGENT_CAPACITY = 1
+ROUTER_BASE_COST = 1
 
 
 def get_client():
@@ -46,6 +70,197 @@ def get_ovs_agents():
     return _get_agents(agent_type='Open vSwitch agent')
 
 
+def load_agent_capacities(path=AGENT_CAPACITY_FILE):
+    capacities = {}
+    if not path:
+        return capacities
+    with open(path) as f:
+        for lineno, line in enumerate(f, 1):
+            fields = line.split()
+            if not fields or fields[0].startswith('#'):
+                continue
+            try:
+                capacities[fields[0]] = float(fields[1])
+            except (IndexError, ValueError):
+                sys.stderr.write("%s:%d: expected '<agent id or host> "
+                                 "<capacity>', line skipped\n"
+                                 % (path, lineno))
+    return capacities
+
+
+def get_agent_capacities(agents, configured=None):
+    """Return {agent_id: capacity} of the L3 agents.
+
+    configured maps agent ids or hosts to capacities, it defaults to
+    AGENT_CAPACITY_FILE; other agents report theirs in
+    configurations['capacity'] or get DEFAULT_AGENT_CAPACITY, as do the
+    agents whose capacity is not a number.
+    """
+    if configured is None:
+        configured = load_agent_capacities()
+    capacities = {}
+    for agent in agents:
+        capacity = configured.get(agent['id'],
+                                  configured.get(agent.get('host')))
+        if capacity is None:
+            capacity = (agent.get('configurations') or {}).get(
+                'capacity', DEFAULT_AGENT_CAPACITY)
+        try:
+            capacity = float(capacity)
+        except (TypeError, ValueError):
+            sys.stderr.write("agent %s: capacity %r is not a number, "
+                             "using %s\n" % (agent['id'], capacity,
+                                             DEFAULT_AGENT_CAPACITY))
+            capacity = DEFAULT_AGENT_CAPACITY
+        capacities[agent['id']] = capacity
+    return capacities
+
+
+def retry_call(func, args=(), retries=RETRY_LIMIT, deadline=RETRY_DEADLINE):
+    """Call func(*args), retrying failures with jittered exponential backoff.
+
+    Gives up and raises the last error after retries retries, or when the
+    next attempt would start more than deadline seconds after the first.
+    NotFound is raised at once, the resource is gone.
+    """
+    start = time.time()
+    attempt = 0
+    while True:
+        try:
+            return func(*args)
+        except exceptions.NotFound:
+            raise
+        except Exception:
+            attempt += 1
+            delay = random.uniform(
+                0, min(RETRY_BACKOFF_MAX, RETRY_BACKOFF * 2 ** attempt))
+            if (attempt > retries
+                    or time.time() + delay - start > deadline):
+                raise
+            time.sleep(delay)
+
+
+def fetch_concurrently(func, keys, workers=ROUTER_WORKERS,
+                       retries=RETRY_LIMIT, deadline=RETRY_DEADLINE):
+    """Call func(key) for every key on a bounded pool of workers.
+
+    Every call is retried through retry_call(). Returns ({key: result},
+    {key: exception}) with the keys that failed for good in the latter.
+    """
+    def _fetch(key):
+        try:
+            return key, retry_call(func, (key,), retries, deadline), None
+        except Exception as e:
+            return key, None, e
+
+    results = {}
+    failures = {}
+    keys = list(keys)
+    pool = multiprocessing.pool.ThreadPool(min(workers, len(keys)) or 1)
+    try:
+        for key, result, error in pool.imap_unordered(_fetch, keys):
+            if error is None:
+                results[key] = result
+            else:
+                failures[key] = error
+    finally:
+        pool.close()
+    return results, failures
+
+
+def _is_ha(router):
+    return router['is_ha'] and router['ha_type'] == 'keepalived'
+
+
+class _AgentLoads(object):
+    """Counters per agent with lazily updated min and max heaps."""
+
+    def __init__(self, agent_ids):
+        self.loads = dict((agent_id, 0) for agent_id in agent_ids)
+        self.order = dict((agent_id, i)
+                          for i, agent_id in enumerate(agent_ids))
+        self.low = [(0, i, agent_id) for i, agent_id in enumerate(agent_ids)]
+        self.high = [(0, i, agent_id) for i, agent_id in enumerate(agent_ids)]
+
+    def __getitem__(self, agent_id):
+        return self.loads[agent_id]
+
+    def add(self, agent_id, step=1):
+        load = self.loads[agent_id] + step
+        self.loads[agent_id] = load
+        heapq.heappush(self.low, (load, self.order[agent_id], agent_id))
+        heapq.heappush(self.high, (-load, self.order[agent_id], agent_id))
+
+    def _pop(self, heap, sign):
+        # drop the entries of outdated loads
+        while heap:
+            load, order, agent_id = heapq.heappop(heap)
+            if sign * load == self.loads[agent_id]:
+                return load, order, agent_id
+        return None
+
+    def _top(self, heap, sign, exclude):
+        skipped = []
+        found = None
+        while True:
+            entry = self._pop(heap, sign)
+            if entry is None:
+                break
+            skipped.append(entry)
+            if entry[2] not in exclude:
+                found = entry[2]
+                break
+        for entry in skipped:
+            heapq.heappush(heap, entry)
+        return found
+
+    def least(self, exclude=()):
+        return self._top(self.low, 1, exclude)
+
+    def most(self, exclude=()):
+        return self._top(self.high, -1, exclude)
+
+    def spread(self):
+        loads = list(self.loads.values()) or [0]
+        return min(loads), max(loads)
+
+
+def _load_bounds(total, agents, tolerance):
+    mean = float(total) / agents
+    lower = min(int(mean), int(math.ceil(mean * (1 - tolerance))))
+    upper = max(int(math.ceil(mean)), int(mean * (1 + tolerance)))
+    return mean, lower, upper
+
+
+def _balance(counts, lower, upper, move):
+    """Move units from the highest to the lowest counts until in bounds.
+
+    move(src, dst) makes one move and returns False when it can not; the
+    next lowest agent is tried then, and a source no agent can take from
+    is left as is.
+    """
+    stuck = set()
+    while True:
+        src = counts.most(exclude=stuck)
+        if src is None:
+            return
+        tried = set()
+        moved = False
+        while not moved:
+            dst = counts.least(exclude=tried)
+            if (dst is None
+                    or not (counts[src] > upper or counts[dst] < lower)
+                    or counts[src] - counts[dst] < 2):
+                break
+            moved = move(src, dst)
+            tried.add(dst)
+        if not moved:
+            if not tried:
+                # even the best pair is balanced
+                return
+            stuck.add(src)
+
+
 class RouterChecker(object):
     def __init__(self):
         self.q_client = get_client()
@@ -60,30 +275,39 @@ class RouterChecker(object):
         self.router_ports_mapping = collections.defaultdict(list)
         self.deprecated_ports = set()
         self.agent_needs_remove = collections.defaultdict(list)
+        # router_id: error of the queries that failed for good
+        self.failed_routers = {}
+        # migration count and load spread of the last rebalance_routers()
+        self.rebalance_summary = []
 
     def get_all_routers(self):
-        routers = self.q_client.list_routers()['routers']
+        routers = retry_call(self.q_client.list_routers)['routers']
         self.routers = routers
-        skipped_routers = []
-        while routers:
-            for router in routers:
-                try:
-                    self._get_router_port(router)
-                except Exception:
-                    skipped_routers.append(router)
-            if skipped_routers:
-                routers = skipped_routers
-                skipped_routers = []
-            else:
-                routers = None
-
-    def _get_router_port(self, router):
+        ha_routers = [router for router in routers if _is_ha(router)]
+        router_ports = self._fetch_router_ports(ha_routers)
+        for router in routers:
+            if router['id'] in self.failed_routers:
+                continue
+            self._check_router(router, router_ports.get(router['id']))
+
+    def _fetch_router_ports(self, routers, workers=ROUTER_WORKERS):
+        """Return {router_id: ports} of routers, queried concurrently.
+
+        No stock API lists the HA state of every router port in one call,
+        so router_port_list is asked per router by a pool of workers.
+        """
+        results, failures = fetch_concurrently(
+            self.q_client.router_port_list,
+            [router['id'] for router in routers], workers)
+        self.failed_routers.update(failures)
+        return dict((router_id, result['ports'])
+                    for router_id, result in results.items())
+
+    def _check_router(self, router, router_ports):
         router_id = router['id']
-        if not router['is_ha'] or router['ha_type'] != 'keepalived':
+        if not _is_ha(router):
             self.non_ha_routers.add(router_id)
             return
-        router_ports =\
-            self.q_client.router_port_list(router['id'])['ports']
         self.router_ports_mapping[router_id] = router_ports
         if not router_ports or len(router_ports) == 1:
             self.unbound_routers.add(router_id)
@@ -191,6 +415,25 @@ class RouterChecker(object):
     def get_l3_binding_db(self, router_id):
         return self.q_client.list_l3_agent_hosting_routers(router_id)['agents']
 
+    def get_l3_bindings_db(self):
+        """Return {router_id: set of agent ids} bound in the DB.
+
+        One query per L3 agent instead of one per router; None when an
+        agent could not be queried and the map would be incomplete.
+        """
+        def _list_routers(agent_id):
+            return self.q_client.list_routers_on_l3_agent(agent_id)['routers']
+
+        agent_routers, failures = fetch_concurrently(
+            _list_routers, [agent['id'] for agent in get_l3_agents()])
+        if failures:
+            return None
+        bindings = collections.defaultdict(set)
+        for agent_id, routers in agent_routers.items():
+            for router in routers:
+                bindings[router['id']].add(agent_id)
+        return bindings
+
     def _get_actual_agents_from_ports(self, router_id):
         ports = self.router_ports_mapping[router_id]
         actual_agent_ids = set()
@@ -204,23 +447,22 @@ class RouterChecker(object):
             return
         ret_mapping = collections.defaultdict(set)
         td_routers = self.unbound_routers | self.spf_routers
-        skipped_routers = set()
-        while td_routers:
-            for router_id in td_routers:
-                agents = None
-                try:
-                    agents = self.get_l3_binding_db(router_id)
-                    db_agent_ids = set([agt['id'] for agt in agents])
-                    actual_agent_ids = self._get_actual_agents_from_ports(
-                        router_id)
-                    need_add = db_agent_ids - actual_agent_ids
-                    for agent_id in need_add:
-                        ret_mapping[agent_id].add(router_id)
-                except Exception:
-                    skipped_routers.add(router_id)
-                    continue
-            td_routers = skipped_routers
-            skipped_routers = set()
+        bindings = self.get_l3_bindings_db()
+        if bindings is None:
+            agents, failures = fetch_concurrently(self.get_l3_binding_db,
+                                                  td_routers)
+            self.failed_routers.update(failures)
+            bindings = dict(
+                (router_id, set([agt['id'] for agt in router_agents]))
+                for router_id, router_agents in agents.items())
+        for router_id in td_routers:
+            if router_id in self.failed_routers:
+                continue
+            db_agent_ids = bindings.get(router_id, set())
+            actual_agent_ids = self._get_actual_agents_from_ports(router_id)
+            need_add = db_agent_ids - actual_agent_ids
+            for agent_id in need_add:
+                ret_mapping[agent_id].add(router_id)
         if dump:
             for agent_id, routers in ret_mapping.items():
                 for router_id in routers:
@@ -228,26 +470,72 @@ class RouterChecker(object):
                           % (agent_id, router_id))
         return ret_mapping
 
-    def _get_least_used_agents(self, agents_usages):
-        tmp = [(k, v) for (k, v) in agents_usages.iteritems()]
-        agents = sorted(tmp, key=lambda x: x[1])
-        return [i[0] for i in agents]
+    def _get_router_cost(self, router_id):
+        """Estimate the work of router_id from its ports.
 
-    def reschedule_routers(self, exclude_l3_agents=None, dump=False):
+        The first port without an agent carries the router's keepalived
+        virtual addresses, one per interface and floating IP; further ones
+        are legs of deleted agents (see _check_router()).
+        """
+        for port in self.router_ports_mapping.get(router_id) or []:
+            if not port['l3_agent_id']:
+                return ROUTER_BASE_COST + len(port.get('fixed_ips') or [])
+        return ROUTER_BASE_COST
+
+    def reschedule_routers(self, exclude_l3_agents=None, dump=False,
+                           l3_agents=None, capacities=None):
         agent_to_remove_router = collections.defaultdict(list)
         agent_to_add_router = collections.defaultdict(list)
         current_agent_routers = {}
         agent_counts = {}
-        all_l3_agents = get_l3_agents()
+        all_l3_agents = l3_agents or get_l3_agents()
         if exclude_l3_agents:
             # ignore excluded l3 agents
             all_l3_agents = [agt for agt in all_l3_agents
                              if agt['id'] not in exclude_l3_agents]
             for agent_id in exclude_l3_agents:
                 self.agent_routers_mapping.pop(agent_id, None)
-        # distribute routers to l3 agents equally
-        router_per_agent =\
-            len(self.routers) * 2 / len(all_l3_agents)
+        # distribute router costs to l3 agents by capacity
+        if capacities is None:
+            capacities = get_agent_capacities(all_l3_agents)
+        costs = dict((router['id'], self._get_router_cost(router['id']))
+                     for router in self.routers)
+        total_cost = sum(costs.values())
+
+        def _capacity(agent_id):
+            return capacities.get(agent_id, DEFAULT_AGENT_CAPACITY)
+
+        total_capacity = sum(_capacity(agt['id']) for agt in all_l3_agents)
+        if total_capacity <= 0:
+            # nothing to weight the agents by, share the cost evenly
+            sys.stderr.write("L3 agents have no capacity, weighting them "
+                             "equally\n")
+            capacities = dict((agt['id'], DEFAULT_AGENT_CAPACITY)
+                              for agt in all_l3_agents)
+            total_capacity = DEFAULT_AGENT_CAPACITY * len(all_l3_agents)
+
+        def _cost(router_id):
+            return costs.get(router_id, ROUTER_BASE_COST)
+
+        def _usage(agent_id, cost):
+            # agents of no capacity are only used when nothing else fits
+            if _capacity(agent_id) <= 0:
+                return float('inf')
+            return cost / float(_capacity(agent_id))
+
+        def _target(agent_id):
+            return int(total_cost * 2 * _capacity(agent_id) /
+                       float(total_capacity))
+
+        def _take(router_list, amount):
+            # split router_list once the routers taken cost amount
+            taken = 0
+            for index, router_id in enumerate(router_list):
+                if taken >= amount:
+                    return router_list[:index], router_list[index:], taken
+                taken += _cost(router_id)
+            return router_list, [], taken
+
         for agent_id, routers in self.agent_routers_mapping.items():
             master = 0
             backup = 0
@@ -265,25 +553,24 @@ class RouterChecker(object):
                     fault = len(router_list)
                     if fault > 0:
                         agent_to_remove_router[agent_id].extend(router_list)
-            # routers should be removed
-            num_to_migrate = master + backup - router_per_agent
+            # cost of the routers that should be removed
+            num_to_migrate = (sum(_cost(router_id) for router_id
+                                  in master_routers + backup_routers)
+                              - _target(agent_id))
             if agent_id in self.agent_needs_remove:
-                num_to_migrate -= len(set(self.agent_needs_remove[agent_id]))
+                num_to_migrate -= sum(
+                    _cost(router_id) for router_id
+                    in set(self.agent_needs_remove[agent_id]))
             if num_to_migrate > 0:
                 # remove backup first
-                if num_to_migrate <= backup:
-                    agent_to_remove_router[agent_id].extend(
-                        backup_routers[:num_to_migrate])
-                    backup_routers = backup_routers[num_to_migrate:]
-                    backup -= num_to_migrate
-                else:
-                    agent_to_remove_router[agent_id].extend(backup_routers)
-                    agent_to_remove_router[agent_id].extend(
-                        master_routers[:(num_to_migrate - backup)])
-                    backup_routers = []
-                    master_routers = master_routers[(num_to_migrate - backup):]
-                    master -= num_to_migrate - backup
-                    backup = 0
+                removed, backup_routers, taken = _take(backup_routers,
+                                                       num_to_migrate)
+                agent_to_remove_router[agent_id].extend(removed)
+                removed, master_routers, taken = _take(
+                    master_routers, num_to_migrate - taken)
+                agent_to_remove_router[agent_id].extend(removed)
+                master = len(master_routers)
+                backup = len(backup_routers)
             current_agent_routers[agent_id] =\
                 set(master_routers) | set(backup_routers)
             agent_counts[agent_id] = {
@@ -297,7 +584,7 @@ class RouterChecker(object):
                 agent_counts[agt['id']] = {
                     'master': 0,
                     'backup': 0,
-                    'num_to_migrate': (0 - router_per_agent)
+                    'num_to_migrate': (0 - _target(agt['id']))
                 }
                 current_agent_routers[agt['id']] = set()
         # bind spf router to another l3 agent
@@ -307,43 +594,60 @@ class RouterChecker(object):
             routers_to_add.extend(routers)
             agent_to_remove_router[agent_id].extend(
                 self.agent_needs_remove[agent_id])
+        # routers waiting for an agent, in order, duplicates kept
+        pending = collections.OrderedDict(enumerate(routers_to_add))
+        added_routers = collections.defaultdict(set)
+
+        def _bind(agent_id, router_id):
+            agent_to_add_router[agent_id].append(router_id)
+            added_routers[agent_id].add(router_id)
+
+        def _hosts(agent_id, router_id):
+            return (router_id in added_routers[agent_id]
+                    or router_id in current_agent_routers[agent_id])
+
         for agent_id, counts in agent_counts.items():
             if counts['num_to_migrate'] < 0:
                 num_to_add = 0 - counts['num_to_migrate']
-                index = 0
-                while num_to_add > 0 and len(routers_to_add) > index:
-                    router_id = routers_to_add[index]
-                    if (router_id in agent_to_add_router[agent_id]
-                            or router_id in current_agent_routers[agent_id]):
-                        index += 1
-                    else:
-                        num_to_add -= 1
-                        agent_to_add_router[agent_id].append(router_id)
-                        del routers_to_add[index]
-        agent_usages = {}
-        for agent_id in agent_counts.keys():
-            agent_usages[agent_id] =\
-                len(agent_to_add_router[agent_id]) +\
-                len(current_agent_routers[agent_id])
-        if len(routers_to_add) > 0:
-            for router_id in routers_to_add:
-                sorted_agents = self._get_least_used_agents(agent_usages)
-                for agt_id in sorted_agents:
-                    if not (router_id in agent_to_add_router[agt_id]
-                            or router_id in current_agent_routers[agt_id]):
-                        agent_to_add_router[agt_id].append(router_id)
-                        agent_usages[agt_id] = agent_usages[agt_id] + 1
+                taken = []
+                for index, router_id in pending.items():
+                    if num_to_add <= 0:
                         break
-        if self.unbound_routers:
-            for router_id in self.unbound_routers:
-                sorted_agents = self._get_least_used_agents(agent_usages)
-                for i in [0, 1]:
-                    for agt_id in sorted_agents:
-                        if not (router_id in agent_to_add_router[agt_id]
-                                or router_id in current_agent_routers[agt_id]):
-                            agent_to_add_router[agt_id].append(router_id)
-                            agent_usages[agt_id] = agent_usages[agt_id] + 1
-                            break
+                    if not _hosts(agent_id, router_id):
+                        num_to_add -= _cost(router_id)
+                        _bind(agent_id, router_id)
+                        taken.append(index)
+                for index in taken:
+                    del pending[index]
+        # least used agent for its capacity first, ties in agent_counts
+        # order
+        agent_heap = [
+            (_usage(agent_id, sum(_cost(router_id) for router_id in
+                                  agent_to_add_router[agent_id] +
+                                  list(current_agent_routers[agent_id]))),
+             order, agent_id)
+            for order, agent_id in enumerate(agent_counts)]
+        heapq.heapify(agent_heap)
+
+        def _schedule(router_id, copies):
+            # bind router_id to the copies least used agents not hosting it
+            skipped = []
+            chosen = []
+            while agent_heap and len(chosen) < copies:
+                usage, order, agent_id = heapq.heappop(agent_heap)
+                if _hosts(agent_id, router_id):
+                    skipped.append((usage, order, agent_id))
+                else:
+                    _bind(agent_id, router_id)
+                    chosen.append((usage + _usage(agent_id, _cost(router_id)),
+                                   order, agent_id))
+            for entry in skipped + chosen:
+                heapq.heappush(agent_heap, entry)
+
+        for router_id in pending.values():
+            _schedule(router_id, 1)
+        for router_id in self.unbound_routers:
+            _schedule(router_id, 2)
         if dump:
             for agent_id, routers in agent_to_remove_router.items():
                 if routers:
@@ -355,6 +659,212 @@ class RouterChecker(object):
                     print('\n'.join(set(routers)))
         return (agent_to_add_router, agent_to_remove_router)
 
+    def rebalance_routers(self, exclude_l3_agents=None, dump=False,
+                          l3_agents=None, tolerance=REBALANCE_TOLERANCE):
+        """Plan the fewest router moves that balance the L3 agents.
+
+        Duplicated HA legs are dropped and missing ones (routers bound to
+        one agent or none, or to an excluded agent) are placed on the least
+        loaded agents. Legs are then moved from the most to the least loaded
+        agent only while an agent is outside tolerance of the mean; every
+        such move closes a unit of surplus or deficit, so no fewer moves can
+        reach the bounds. When the least loaded agent already hosts every
+        router it could take, the next one is tried. The legs of a router
+        always stay on distinct agents.
+
+        Keepalived elects the masters, the plan can not place them: a new
+        leg starts as backup and removing a master fails over to its peer.
+        Backups are moved first so as to cause no failover, a master only
+        when no backup can go, and the master spread printed is the one
+        projected from these failovers.
+        """
+        exclude_l3_agents = set(exclude_l3_agents or [])
+        agent_ids = [agt['id'] for agt in l3_agents or get_l3_agents()
+                     if agt['id'] not in exclude_l3_agents]
+        if not agent_ids:
+            return ({}, {})
+        # router legs per agent and state, agents per router
+        legs = dict((agent_id, {'MASTER': set(), 'BACKUP': set(),
+                                'FAULT': set()})
+                    for agent_id in agent_ids)
+        router_agents = collections.defaultdict(set)
+        loads = _AgentLoads(agent_ids)
+        masters = _AgentLoads(agent_ids)
+        orig_legs = {}
+        # legs on excluded agents and missing legs, to bind anew
+        to_place = []
+        leg_counts = collections.Counter()
+        # routers whose master is on an excluded agent
+        lost_masters = set()
+        failovers = collections.Counter()
+        for agent_id, routers in self.agent_routers_mapping.items():
+            for state, router_list in routers.items():
+                for router_id in router_list:
+                    orig_legs[(agent_id, router_id)] = state
+                    leg_counts[router_id] += 1
+                    if agent_id not in legs:
+                        to_place.append(router_id)
+                        if state == 'MASTER':
+                            lost_masters.add(router_id)
+                        continue
+                    legs[agent_id][state].add(router_id)
+                    router_agents[router_id].add(agent_id)
+                    loads.add(agent_id)
+                    if state == 'MASTER':
+                        masters.add(agent_id)
+        for router_id in self.spf_routers | self.unbound_routers:
+            while leg_counts[router_id] < 2:
+                to_place.append(router_id)
+                leg_counts[router_id] += 1
+
+        def _failover(router_id):
+            # a backup leg of the router takes over the lost master
+            failovers[router_id] += 1
+            for agent_id in sorted(router_agents[router_id]):
+                if router_id in legs[agent_id]['BACKUP']:
+                    legs[agent_id]['BACKUP'].discard(router_id)
+                    legs[agent_id]['MASTER'].add(router_id)
+                    masters.add(agent_id)
+                    return True
+            return False
+
+        def _place(router_id, agent_id):
+            # a new leg is a backup, unless the router has no healthy leg
+            healthy = any(router_id in legs[agent]['MASTER'] or
+                          router_id in legs[agent]['BACKUP']
+                          for agent in router_agents[router_id])
+            state = 'BACKUP' if healthy else 'MASTER'
+            _bind(router_id, state, agent_id)
+
+        def _bind(router_id, state, agent_id):
+            legs[agent_id][state].add(router_id)
+            router_agents[router_id].add(agent_id)
+            loads.add(agent_id)
+            if state == 'MASTER':
+                masters.add(agent_id)
+
+        def _unbind(router_id, state, agent_id):
+            legs[agent_id][state].discard(router_id)
+            router_agents[router_id].discard(agent_id)
+            loads.add(agent_id, -1)
+            if state == 'MASTER':
+                masters.add(agent_id, -1)
+
+        def _find(src, dst, states):
+            # a leg of src whose router dst does not host yet
+            for state in states:
+                for router_id in legs[src][state]:
+                    if dst not in router_agents[router_id]:
+                        return router_id, state
+            return None
+
+        def _move_load(src, dst):
+            # a backup when one can go, a master fails over
+            leg = _find(src, dst, ['BACKUP', 'MASTER'])
+            if not leg:
+                return False
+            router_id, state = leg
+            _unbind(router_id, state, src)
+            if state == 'MASTER':
+                _failover(router_id)
+            _place(router_id, dst)
+            return True
+
+        before = (loads.spread(), masters.spread())
+        for router_id in lost_masters:
+            _failover(router_id)
+        for router_id in to_place:
+            agent_id = loads.least(exclude=router_agents[router_id])
+            if agent_id:
+                _place(router_id, agent_id)
+        mean, lower, upper = _load_bounds(sum(loads.loads.values()),
+                                          len(agent_ids), tolerance)
+        _balance(loads, lower, upper, _move_load)
+        m_mean = float(sum(masters.loads.values())) / len(agent_ids)
+
+        agent_to_add_router = collections.defaultdict(list)
+        agent_to_remove_router = collections.defaultdict(list)
+        migrated = 0
+        for agent_id, router_id in orig_legs:
+            if agent_id not in router_agents[router_id]:
+                agent_to_remove_router[agent_id].append(router_id)
+                migrated += 1
+        for agent_id, states in legs.items():
+            for router_list in states.values():
+                for router_id in router_list:
+                    if (agent_id, router_id) not in orig_legs:
+                        agent_to_add_router[agent_id].append(router_id)
+        added = sum(len(routers) for routers in agent_to_add_router.values())
+        for agent_id, routers in self.agent_needs_remove.items():
+            agent_to_remove_router[agent_id].extend(set(routers))
+        after = (loads.spread(), masters.spread())
+        self.rebalance_summary = [
+            "%d router legs migrated (%d masters failed over), %d bound, "
+            "%d duplicated removed" % (
+                migrated, sum(failovers.values()), added - migrated,
+                sum(len(set(routers)) for routers
+                    in self.agent_needs_remove.values())),
+            "load per agent: mean %.1f, min %d max %d -> min %d max %d"
+            % ((mean,) + before[0] + after[0]),
+            "masters per agent: mean %.1f, min %d max %d -> projected "
+            "min %d max %d" % ((m_mean,) + before[1] + after[1])]
+        if dump:
+            print('\n'.join(self.rebalance_summary))
+            for agent_id, routers in agent_to_remove_router.items():
+                if routers:
+                    print("\nAgent %s need to remove routers" % agent_id)
+                    print('\n'.join(routers))
+            for agent_id, routers in agent_to_add_router.items():
+                if routers:
+                    print("\nAgent %s need to add routers" % agent_id)
+                    print('\n'.join(routers))
+        return (agent_to_add_router, agent_to_remove_router)
+
+    def report_failures(self):
+        if not self.failed_routers:
+            return
+        sys.stderr.write("\n%d routers skipped, queries failed:\n"
+                         % len(self.failed_routers))
+        for router_id, error in sorted(self.failed_routers.items()):
+            sys.stderr.write("%s: %s\n" % (router_id, error))
+
+
+def benchmark_reschedule(num_routers=BENCHMARK_ROUTERS,
+                         num_agents=BENCHMARK_AGENTS):
+    """Time reschedule_routers() on a synthetic cloud, no API calls.
+
+    A third of the agents are new and empty, 2% of the routers are bound
+    to one agent only and 1% to none.
+    """
+    rnd = random.Random(0)
+    agents = [{'id': str(uuid.UUID(int=rnd.getrandbits(128)))}
+              for i in range(num_agents)]
+    old_agents = [agent['id'] for agent in agents[:num_agents * 2 // 3]]
+    router_checker = RouterChecker()
+    router_checker.routers = []
+    for i in range(num_routers):
+        router_id = str(uuid.UUID(int=rnd.getrandbits(128)))
+        router_checker.routers.append({'id': router_id})
+        kind = rnd.random()
+        if kind < 0.01:
+            router_checker.unbound_routers.add(router_id)
+            continue
+        bound = rnd.sample(old_agents, 1 if kind < 0.03 else 2)
+        if len(bound) == 1:
+            router_checker.spf_routers.add(router_id)
+        for agent_id, state in zip(bound, ['MASTER', 'BACKUP']):
+            router_checker.agent_routers_mapping.setdefault(
+                agent_id, collections.defaultdict(list))[state].append(
+                    router_id)
+    start = time.time()
+    agent_to_add, agent_to_remove = router_checker.reschedule_routers(
+        l3_agents=agents)
+    print("%d routers, %d agents: %d removes, %d adds planned in %.2fs"
+          % (num_routers, num_agents,
+             sum(len(routers) for routers in agent_to_remove.values()),
+             sum(len(routers) for routers in agent_to_add.values()),
+             time.time() - start))
+
 
 def help():
     doc = """
@@ -365,6 +875,9 @@ command:
     recover-ha
     router-reschedule [exclude-l3-agent-uuid-list]
     router-reschedule-script [exclude-l3-agent-uuid-list]
+    router-reschedule-benchmark [routers [agents]]
+    router-rebalance [exclude-l3-agent-uuid-list]
+    router-rebalance-script [exclude-l3-agent-uuid-list]
     """
     print(doc)
 
@@ -387,10 +900,12 @@ def main(argv):
         router_checker = RouterChecker()
         router_checker.get_all_routers()
         router_checker.check_routers_state()
+        router_checker.report_failures()
     elif command == 'recover-ha':
         router_checker = RouterChecker()
         router_checker.get_all_routers()
         router_checker.recover_ha(dump=True)
+        router_checker.report_failures()
     elif command == 'router-reschedule':
         if len(argv) > 2:
             for id_str in argv[2:]:
@@ -403,6 +918,7 @@ def main(argv):
         router_checker.get_all_routers()
         router_checker.reschedule_routers(exclude_l3_agents=exclude_l3_agents,
                                           dump=True)
+        router_checker.report_failures()
     elif command == 'router-reschedule-script':
         if len(argv) > 2:
             for id_str in argv[2:]:
@@ -425,6 +941,48 @@ def main(argv):
             for router in routers:
                 print("neutron l3-agent-router-add %s %s"
                       % (agent_id, router))
+        router_checker.report_failures()
+    elif command == 'router-rebalance':
+        if len(argv) > 2:
+            for id_str in argv[2:]:
+                if _is_uuid(id_str):
+                    exclude_l3_agents.append(id_str)
+                else:
+                    help()
+                    return
+        router_checker = RouterChecker()
+        router_checker.get_all_routers()
+        router_checker.rebalance_routers(exclude_l3_agents=exclude_l3_agents,
+                                         dump=True)
+        router_checker.report_failures()
+    elif command == 'router-rebalance-script':
+        if len(argv) > 2:
+            for id_str in argv[2:]:
+                if _is_uuid(id_str):
+                    exclude_l3_agents.append(id_str)
+                else:
+                    help()
+                    return
+        router_checker = RouterChecker()
+        router_checker.get_all_routers()
+        agent_to_add, agent_to_remove = router_checker.rebalance_routers(
+            exclude_l3_agents=exclude_l3_agents)
+        for line in router_checker.rebalance_summary:
+            print("# %s" % line)
+        # add the new legs first, a router keeps a leg during the move
+        print("\n# Add routers to agent")
+        for agent_id, routers in agent_to_add.items():
+            for router in routers:
+                print("neutron l3-agent-router-add %s %s"
+                      % (agent_id, router))
+        print("\n# Remove routers from agent")
+        for agent_id, routers in agent_to_remove.items():
+            for router in routers:
+                print("neutron l3-agent-router-remove %s %s"
+                      % (agent_id, router))
+        router_checker.report_failures()
+    elif command == 'router-reschedule-benchmark':
+        benchmark_reschedule(*[int(arg) for arg in argv[2:4]])
     else:
         help()
 
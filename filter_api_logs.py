@@ -1,7 +1,69 @@
 #!/usr/bin/python
 
+import argparse
+import array
+import calendar
+import collections
+import ctypes
+import ctypes.util
 import datetime
+import glob
+import gzip
+import hashlib
+import heapq
+import itertools
+import json
+import math
+import mmap
+import multiprocessing
+import os
+import pickle
+import re
+import struct
 import sys
+import time as _time
+import uuid
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# bounds of the per request buffers used by scan_slow_requests()
+MAX_PENDING_REQUESTS = 10000
+MAX_LINES_PER_REQUEST = 5000
+# size of the byte ranges scanned by each worker of scan_slow_requests()
+CHUNK_SIZE = 64 * 1024 * 1024
+# sidecar request_id index, see update_index()
+INDEX_SUFFIX = '.idx'
+INDEX_VERSION = 2
+# relative precision and smallest value (seconds) of LatencyHistogram
+HISTOGRAM_PRECISION = 0.01
+HISTOGRAM_MIN = 0.001
+REPORT_PERCENTILES = (50, 90, 99)
+# read size of follow_slow_requests() and its poll interval without inotify
+FOLLOW_READ_SIZE = 1024 * 1024
+FOLLOW_POLL_INTERVAL = 1.0
+
+# columns written by export_requests(), name: array typecode
+EXPORT_COLUMNS = collections.OrderedDict([
+    ('request_id', 'B'),  # 16 bytes of the request uuid per row
+    ('timestamp', 'd'),   # seconds since the epoch, log timezone
+    ('time', 'd'),
+    ('tenant_id', 'I'),   # codes into the strings dictionary
+    ('user_id', 'I'),
+    ('api', 'I'),
+])
+EXPORT_VERSION = 1
+
+# rows printed by the gap analysis
+GAP_REPORT_TOP = 30
+
+ID_PATTERN = re.compile(r'[0-9a-fA-F]{8}-?[0-9a-fA-F]{4}-?[0-9a-fA-F]{4}-?'
+                        r'[0-9a-fA-F]{4}-?[0-9a-fA-F]{12}|(?<=/)\d+(?=[/.]|$)')
+TEMPLATE_PATTERN = re.compile(
+    r'[0-9a-fA-F]{8}-?[0-9a-fA-F]{4}-?[0-9a-fA-F]{4}-?[0-9a-fA-F]{4}-?'
+    r'[0-9a-fA-F]{12}|\b[0-9a-fA-F]{32,}\b|\d+(?:\.\d+)*')
 
 
 def filter_requests(search_str=None, threshold=1.0, file_path=None):
@@ -9,7 +71,7 @@ def filter_requests(search_str=None, threshold=1.0, file_path=None):
         return
     all_reqs = []
     with open(file_path) as f:
-        for line in f.readlines():
+        for line in f:
             if line.find(search_str) > 0:
                 parts = line.split(' ')
                 time = float(parts[18])
@@ -28,34 +90,112 @@ def filter_requests(search_str=None, threshold=1.0, file_path=None):
 def _get_datetime(date, time):
     date_list = [int(d) for d in date.split('-')]
     time_list = [int(d) for d in time.split('.')[0].split(':')]
-    ms = int(time.split('.')[1])
-    args = tuple(date_list) + tuple(time_list) + (ms,)
+    # the fraction is milliseconds in neutron logs, datetime wants micro
+    us = int(time.split('.')[1].ljust(6, '0')[:6])
+    args = tuple(date_list) + tuple(time_list) + (us,)
     return datetime.datetime(*args)
 
 
+def _parse_timestamp(line):
+    # fast path for the fixed width "YYYY-MM-DD HH:MM:SS.mmm " prefix
+    if line[4:5] == '-' and line[10:11] == ' ' and line[23:24] == ' ':
+        try:
+            return datetime.datetime(
+                int(line[0:4]), int(line[5:7]), int(line[8:10]),
+                int(line[11:13]), int(line[14:16]), int(line[17:19]),
+                int(line[20:23]) * 1000)
+        except ValueError:
+            pass
+    parts = line.split(' ', 2)
+    return _get_datetime(parts[0], parts[1])
+
+
+class LogRecord(object):
+    """One parsed log line, fields are sliced out of the line on access.
+
+    Supports the keys of the dicts parse_log() used to return, so
+    record['content'] and friends keep working.
+    """
+    __slots__ = ('line', 'start', '_datetime', '_spaces')
+    _keys = frozenset(['datetime', 'code', 'req_id', 'tenant_id', 'user_id',
+                       'delta', 'content'])
+
+    def __init__(self, line, start=None):
+        self.line = line
+        self.start = start
+        self._datetime = None
+        self._spaces = None
+
+    def __getitem__(self, key):
+        if key not in self._keys:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def _field(self, index):
+        # same as line.split(' ')[index] for index < 8, index 8 is the rest
+        spaces = self._spaces
+        if spaces is None:
+            spaces = [-1]
+            pos = -1
+            for _ in range(8):
+                pos = self.line.find(' ', pos + 1)
+                if pos < 0:
+                    break
+                spaces.append(pos)
+            self._spaces = spaces
+        if index >= len(spaces):
+            if index == 8:
+                return ''
+            raise IndexError(index)
+        if index + 1 < len(spaces) and index < 8:
+            return self.line[spaces[index] + 1:spaces[index + 1]]
+        return self.line[spaces[index] + 1:]
+
+    @property
+    def datetime(self):
+        if self._datetime is None:
+            self._datetime = _parse_timestamp(self.line)
+        return self._datetime
+
+    @property
+    def delta(self):
+        if self.start is None:
+            return None
+        return self.datetime - self.start
+
+    @property
+    def host(self):
+        return getattr(self.line, 'host', None)
+
+    @property
+    def code(self):
+        return self._field(4)
+
+    @property
+    def req_id(self):
+        return self._field(5)[1:]
+
+    @property
+    def user_id(self):
+        return self._field(6)
+
+    @property
+    def tenant_id(self):
+        return self._field(7)[:-1]
+
+    @property
+    def content(self):
+        return self._field(8)
+
+
 def parse_log(logs=[]):
     parsed_logs = []
     start = None
     for log in logs:
-        parts = log.split(' ')
-        date = parts[0]
-        time = parts[1]
-        dt = _get_datetime(date, time)
-        if not start:
-            start = dt
-            delta = None
-        else:
-            delta = dt - start
-        parsed_log = {
-            'datetime': dt,
-            'code': parts[4],
-            'req_id': parts[5][1:],
-            'tenant_id': parts[7][:-1],
-            'user_id': parts[6],
-            'delta': delta,
-            'content': " ".join(parts[8:])
-        }
-        parsed_logs.append(parsed_log)
+        record = LogRecord(log, start)
+        if start is None:
+            start = record.datetime
+        parsed_logs.append(record)
     return parsed_logs
 
 
@@ -67,6 +207,9 @@ def print_parsed_log(parsed_log):
     else:
         str_list.append(str(parsed_log['datetime']))
     str_list.append(parsed_log['tenant_id'])
+    host = getattr(parsed_log, 'host', None)
+    if host:
+        str_list.append('[%s]' % host)
     str_list.append(parsed_log['content'])
     print(" ".join(str_list))
 
@@ -77,7 +220,7 @@ def get_logs_by_request_ids(reqs=[], file_path=None):
     reqs_set = set(reqs)
     all_logs = {}
     with open(file_path) as f:
-        for line in f.readlines():
+        for line in f:
             line = line.rstrip('\n')
             parts = line.split(' ')
             if len(parts) < 6:
@@ -93,6 +236,891 @@ def get_logs_by_request_ids(reqs=[], file_path=None):
     return all_logs
 
 
+def _get_request_id(parts):
+    if len(parts) < 6 or not parts[5].startswith('[req-'):
+        return None
+    return parts[5][1:]
+
+
+def _get_completion_time(parts):
+    # the wsgi access line is the last line of a request, e.g.
+    # ... [req-x user tenant] 10.0.0.1 - - [date time] "POST /v2.0/ports
+    # HTTP/1.1" 201 1234 0.123
+    if len(parts) < 19 or not parts[13].startswith('"'):
+        return None
+    try:
+        return float(parts[18])
+    except ValueError:
+        return None
+
+
+class PatternMatcher(object):
+    """Match wsgi lines against many (search_str, threshold) pairs at once.
+
+    A single compiled alternation rejects most lines in one regex search;
+    only lines it accepts are checked pattern by pattern to find every
+    pattern (over its own threshold) they belong to.
+    """
+
+    def __init__(self, patterns):
+        self.thresholds = collections.OrderedDict(patterns)
+        self.min_threshold = min(self.thresholds.values())
+        alternation = '|'.join(
+            re.escape(p) for p in sorted(self.thresholds, key=len,
+                                         reverse=True))
+        self.regex = re.compile(alternation)
+
+    def match(self, line, time):
+        if time < self.min_threshold or not self.regex.search(line, 1):
+            return []
+        return [p for p, threshold in self.thresholds.items()
+                if time >= threshold and line.find(p) > 0]
+
+
+def _get_matcher(search_str, threshold, patterns):
+    if patterns:
+        return PatternMatcher(patterns)
+    if search_str:
+        return PatternMatcher([(search_str, threshold)])
+    return None
+
+
+def _scan_lines(lines, matcher, pending,
+                max_pending=MAX_PENDING_REQUESTS,
+                max_lines=MAX_LINES_PER_REQUEST, done=None):
+    # done, when given, collects the requests finished without matching
+    for line in lines:
+        parts = line.split(' ')
+        req_id = _get_request_id(parts)
+        if not req_id:
+            continue
+        logs = pending.get(req_id)
+        if logs is None:
+            if len(pending) >= max_pending:
+                pending.popitem(last=False)
+            logs = pending[req_id] = []
+        if len(logs) < max_lines:
+            logs.append(line)
+        time = _get_completion_time(parts)
+        if time is None:
+            continue
+        del pending[req_id]
+        matched = matcher.match(line, time)
+        if not matched:
+            if done is not None:
+                done.append(req_id)
+            continue
+        if len(logs) == max_lines:
+            # always keep the wsgi line of a truncated request
+            logs[-1] = line
+        info = {
+            'request_id': req_id,
+            'tenant_id': parts[7],
+            'user_id': parts[6],
+            'time': time,
+            'patterns': matched
+        }
+        yield info, logs
+
+
+def _open_log(file_path):
+    if file_path.endswith('.gz'):
+        return gzip.open(file_path, 'rb')
+    return open(file_path, 'rb')
+
+
+def _read_lines(file_path, start=0, end=None):
+    with _open_log(file_path) as f:
+        if start:
+            f.seek(start)
+        pos = start
+        for line in f:
+            if end is not None and pos >= end:
+                break
+            pos += len(line)
+            yield line.decode('utf-8', 'replace').rstrip('\n')
+
+
+class HostLine(str):
+    """A log line remembering the host it was read from."""
+
+    def __new__(cls, line, host):
+        obj = str.__new__(cls, line)
+        obj.host = host
+        return obj
+
+
+def _timestamped_lines(index, host, file_paths):
+    # lines without a timestamp (e.g. tracebacks) keep the previous one;
+    # index orders the lines of different hosts logged at the same time
+    dt = datetime.datetime.min
+    for file_path in file_paths:
+        for line in _read_lines(file_path):
+            try:
+                dt = _parse_timestamp(line)
+            except (ValueError, IndexError):
+                pass
+            yield dt, index, HostLine(line, host)
+
+
+def merge_host_logs(host_files):
+    """Merge the logs of several hosts into one stream ordered by time.
+
+    host_files is a list of (host, file_paths), the files of a host being
+    read one after the other (oldest rotated file first). The heap keeps a
+    single line per host, so memory does not grow with the logs.
+    """
+    streams = [_timestamped_lines(index, host, file_paths)
+               for index, (host, file_paths) in enumerate(host_files)]
+    for dt, index, line in heapq.merge(*streams):
+        yield line
+
+
+def scan_merged_requests(search_str=None, threshold=1.0, host_files=None,
+                         max_pending=MAX_PENDING_REQUESTS,
+                         max_lines=MAX_LINES_PER_REQUEST, patterns=None):
+    """Yield (info, logs) of slow requests across the logs of many hosts.
+
+    The lines of a request are correlated by request_id over the merged
+    timeline, whichever host logged them; every line is a HostLine.
+    """
+    matcher = _get_matcher(search_str, threshold, patterns)
+    if not matcher or not host_files:
+        return
+    pending = collections.OrderedDict()
+    for item in _scan_lines(merge_host_logs(host_files), matcher, pending,
+                            max_pending, max_lines):
+        yield item
+
+
+def _rotation_key(file_path):
+    # neutron-server.log.3.gz < neutron-server.log.1 < neutron-server.log
+    name = file_path[:-3] if file_path.endswith('.gz') else file_path
+    base, _, suffix = name.rpartition('.')
+    if base and suffix.isdigit():
+        return (base, -int(suffix))
+    return (name, 0)
+
+
+def expand_log_files(patterns, rotated=False):
+    """Expand globs (and rotated sets) into a list of files, oldest first."""
+    files = set()
+    for pattern in patterns:
+        matched = glob.glob(pattern) or [pattern]
+        if rotated:
+            for path in list(matched):
+                # path.1, path.2.gz, but not sidecars like path.2.idx
+                rotated_name = re.compile(re.escape(path) + r'\.\d+(\.gz)?$')
+                matched.extend(name for name in glob.glob(path + '.[0-9]*')
+                               if rotated_name.match(name))
+        files.update(matched)
+    return sorted(files, key=_rotation_key)
+
+
+def _split_file(file_path, chunk_size=CHUNK_SIZE, start=0, size=None):
+    if file_path.endswith('.gz') or not os.path.isfile(file_path):
+        # gzip streams cannot be seeked cheaply, nor can pipes (e.g.
+        # /dev/stdin) be seeked at all, scan them as a whole
+        return [(file_path, start, None)]
+    if size is None:
+        size = os.path.getsize(file_path)
+    ranges = []
+    with open(file_path, 'rb') as f:
+        while start < size:
+            end = start + chunk_size
+            if end < size:
+                # move the boundary to the start of the next line
+                f.seek(end)
+                f.readline()
+                end = f.tell()
+            else:
+                end = size
+            ranges.append((file_path, start, end))
+            start = end
+    return ranges
+
+
+def _imap_chunks(func, file_paths, args, workers=None, chunk_size=CHUNK_SIZE):
+    # run func((path, start, end) + args) for every byte range of the files
+    # and yield the results in file order, a file may be given as
+    # (path, start, size) to only scan a part of it
+    tasks = []
+    for file_path in file_paths:
+        if isinstance(file_path, tuple):
+            ranges = _split_file(file_path[0], chunk_size, *file_path[1:])
+        else:
+            ranges = _split_file(file_path, chunk_size)
+        for path, start, end in ranges:
+            tasks.append((path, start, end) + tuple(args))
+    if len(tasks) == 1 or workers == 1:
+        for task in tasks:
+            yield func(task)
+        return
+    pool = multiprocessing.Pool(processes=workers)
+    try:
+        for result in pool.imap(func, tasks):
+            yield result
+    finally:
+        pool.terminate()
+
+
+def _scan_chunk(args):
+    file_path, start, end, matcher, max_pending, max_lines = args
+    pending = collections.OrderedDict()
+    done = []
+    slow = list(_scan_lines(_read_lines(file_path, start, end), matcher,
+                            pending, max_pending, max_lines, done))
+    return slow, pending, done
+
+
+def scan_slow_requests(search_str=None, threshold=1.0, file_paths=None,
+                       workers=None, chunk_size=CHUNK_SIZE,
+                       max_pending=MAX_PENDING_REQUESTS,
+                       max_lines=MAX_LINES_PER_REQUEST, patterns=None):
+    """Scan several logs with a process pool and yield (info, logs).
+
+    Files are split into line aligned byte ranges (gzip files are scanned
+    whole) and every range is scanned by a worker. The ranges are merged
+    in file order: requests left unfinished at the end of a range are
+    carried over and prepended to their lines from the following ranges,
+    so a request may span chunk and rotation boundaries. With workers=1
+    the ranges are scanned in this process.
+
+    Lines are buffered per request_id until the wsgi line of the request
+    shows up, so only requests in flight are kept in memory. The oldest
+    request is evicted when more than max_pending requests never finish,
+    and at most max_lines lines are kept for a single request.
+
+    patterns is a list of (search_str, threshold) searched together
+    instead of search_str, info['patterns'] lists the ones that matched.
+    """
+    matcher = _get_matcher(search_str, threshold, patterns)
+    if not matcher or not file_paths:
+        return
+    results = _imap_chunks(_scan_chunk, file_paths,
+                           (matcher, max_pending, max_lines),
+                           workers=workers, chunk_size=chunk_size)
+    carry = collections.OrderedDict()
+    for slow, pending, done in results:
+        # finished below the threshold, their earlier lines are not needed
+        for req_id in done:
+            carry.pop(req_id, None)
+        for info, logs in slow:
+            head = carry.pop(info['request_id'], None)
+            if head:
+                logs = head + logs
+                if len(logs) > max_lines:
+                    logs = logs[:max_lines - 1] + logs[-1:]
+            yield info, logs
+        for req_id, logs in pending.items():
+            head = carry.pop(req_id, None)
+            if head:
+                logs = (head + logs)[:max_lines]
+            carry[req_id] = logs
+        while len(carry) > max_pending:
+            carry.popitem(last=False)
+
+
+def _get_api(parts):
+    return parts[13][1:] + ' ' + parts[14]
+
+
+def _log_fingerprint(file_path):
+    with open(file_path, 'rb') as f:
+        return f.readline()
+
+
+def _add_to_index(index, entries, max_pending):
+    # replay the (request_id, offset, time) of indexed lines, time being
+    # set on the wsgi line which completes the request
+    requests = index['requests']
+    pending = index['pending']
+    for req_id, offset, time in entries:
+        offsets = pending.get(req_id)
+        if offsets is None:
+            if len(pending) >= max_pending:
+                pending.popitem(last=False)
+            offsets = pending[req_id] = []
+        offsets.append(offset)
+        if time is not None:
+            del pending[req_id]
+            requests[req_id] = (time, offsets)
+
+
+def load_index(file_path, max_pending=MAX_PENDING_REQUESTS):
+    """Load the sidecar index of file_path, None if missing or stale.
+
+    The index is stale when the log was rotated: a different inode, a file
+    shorter than the indexed size or a different first line.
+    """
+    try:
+        f = open(file_path + INDEX_SUFFIX, 'rb')
+    except (IOError, OSError):
+        return None
+    with f:
+        try:
+            header = pickle.load(f)
+        except (EOFError, ValueError, pickle.UnpicklingError):
+            return None
+        if (not isinstance(header, dict)
+                or header.get('version') != INDEX_VERSION):
+            return None
+        index = dict(header, size=0, requests={},
+                     pending=collections.OrderedDict(), end=f.tell())
+        while True:
+            try:
+                size, entries = pickle.load(f)
+            except (EOFError, ValueError, IndexError,
+                    pickle.UnpicklingError):
+                # the end, or a record cut short by an interrupted update
+                break
+            _add_to_index(index, entries, max_pending)
+            index['size'] = size
+            index['end'] = f.tell()
+    stat = os.stat(file_path)
+    if (index['inode'] != stat.st_ino or index['size'] > stat.st_size
+            or (index['size']
+                and index['fingerprint'] != _log_fingerprint(file_path))):
+        return None
+    return index
+
+
+def update_index(file_path, max_pending=MAX_PENDING_REQUESTS):
+    """Build or extend the sidecar index of file_path and return it.
+
+    The index maps every finished request_id to (time, offsets), the
+    completion time of its wsgi line and the byte offsets of all its
+    lines. Only the part of the log written since the last update is
+    read, and appended to the index file as one record of its lines;
+    unfinished requests are kept in the index until they complete.
+    """
+    index = load_index(file_path, max_pending)
+    if index is None:
+        index = {
+            'version': INDEX_VERSION,
+            'inode': os.stat(file_path).st_ino,
+            'fingerprint': _log_fingerprint(file_path),
+            'size': 0,
+            'requests': {},
+            'pending': collections.OrderedDict(),
+            'end': 0,
+        }
+    entries = []
+    pos = index['size']
+    with open(file_path, 'rb') as f:
+        f.seek(pos)
+        for raw in f:
+            if not raw.endswith(b'\n'):
+                # line still being written, index it next time
+                break
+            offset = pos
+            pos += len(raw)
+            parts = raw.decode('utf-8', 'replace').rstrip('\n').split(' ')
+            req_id = _get_request_id(parts)
+            if req_id:
+                entries.append((req_id, offset, _get_completion_time(parts)))
+    if pos == index['size']:
+        return index
+    _add_to_index(index, entries, max_pending)
+    index_path = file_path + INDEX_SUFFIX
+    if not index['size']:
+        # a new index, or the log was empty when it was made
+        index['fingerprint'] = _log_fingerprint(file_path)
+        header = dict((key, index[key])
+                      for key in ('version', 'inode', 'fingerprint'))
+        tmp_path = index_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(header, f, pickle.HIGHEST_PROTOCOL)
+            pickle.dump((pos, entries), f, pickle.HIGHEST_PROTOCOL)
+            index['end'] = f.tell()
+        os.rename(tmp_path, index_path)
+    else:
+        with open(index_path, 'ab') as f:
+            # drop whatever an interrupted update appended
+            f.truncate(index['end'])
+            f.seek(index['end'])
+            pickle.dump((pos, entries), f, pickle.HIGHEST_PROTOCOL)
+            index['end'] = f.tell()
+    index['size'] = pos
+    return index
+
+
+def _read_line(mm, offset):
+    end = mm.find(b'\n', offset)
+    return mm[offset:end].decode('utf-8', 'replace')
+
+
+def query_index(search_str=None, threshold=1.0, file_path=None, index=None,
+                max_lines=MAX_LINES_PER_REQUEST, patterns=None):
+    """Yield (info, logs) of slow requests by seeking with the index."""
+    matcher = _get_matcher(search_str, threshold, patterns)
+    if not matcher or not file_path:
+        return
+    if index is None:
+        index = update_index(file_path)
+    if not index['size']:
+        return
+    with open(file_path, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), index['size'], access=mmap.ACCESS_READ)
+        try:
+            for req_id, (time, offsets) in index['requests'].items():
+                if time < matcher.min_threshold:
+                    continue
+                # match on the wsgi line before reading the others
+                line = _read_line(mm, offsets[-1])
+                matched = matcher.match(line, time)
+                if not matched:
+                    continue
+                if len(offsets) > max_lines:
+                    offsets = offsets[:max_lines - 1] + offsets[-1:]
+                logs = [_read_line(mm, offset) for offset in offsets[:-1]]
+                logs.append(line)
+                parts = line.split(' ')
+                info = {
+                    'request_id': req_id,
+                    'tenant_id': parts[7],
+                    'user_id': parts[6],
+                    'time': time,
+                    'patterns': matched
+                }
+                yield info, logs
+        finally:
+            mm.close()
+
+
+class LatencyHistogram(object):
+    """Log bucketed latency histogram with bounded memory.
+
+    Values are counted in buckets growing by HISTOGRAM_PRECISION, so any
+    quantile is exact to that relative error; at 1% about 1,500 buckets
+    cover everything from a millisecond to an hour, and only the buckets
+    actually hit are stored.
+    """
+    _log_base = math.log(1 + HISTOGRAM_PRECISION)
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        if value > HISTOGRAM_MIN:
+            bucket = int(math.ceil(math.log(value / HISTOGRAM_MIN)
+                                   / self._log_base))
+        else:
+            bucket = 0
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        for bucket, count in other.buckets.items():
+            self.buckets[bucket] = self.buckets.get(bucket, 0) + count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, pct):
+        if not self.count:
+            return 0.0
+        rank = pct / 100.0 * self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min(self._value(bucket), self.max)
+        return self.max
+
+    def _value(self, bucket):
+        return HISTOGRAM_MIN * math.exp(bucket * self._log_base)
+
+
+def _normalize_api(parts):
+    # strip query strings and ids so that every resource maps to one key
+    path = ID_PATTERN.sub('{id}', parts[14].split('?')[0])
+    return parts[13][1:] + ' ' + path
+
+
+class LatencyReport(object):
+    """Latency histograms per API, per tenant and per minute.
+
+    Requests at or over threshold are also counted exactly per group.
+    """
+    groups = ('by_api', 'by_tenant', 'by_minute')
+
+    def __init__(self, threshold=None):
+        self.threshold = threshold
+        self.by_api = collections.defaultdict(LatencyHistogram)
+        self.by_tenant = collections.defaultdict(LatencyHistogram)
+        self.by_minute = collections.defaultdict(LatencyHistogram)
+        self.over = collections.Counter()
+
+    def add_line(self, line, search_str=None):
+        parts = line.split(' ')
+        time = _get_completion_time(parts)
+        if time is None or (search_str and line.find(search_str) <= 0):
+            return
+        keys = (_normalize_api(parts), parts[7].rstrip(']'),
+                parts[0] + ' ' + parts[1][:5])
+        for name, key in zip(self.groups, keys):
+            getattr(self, name)[key].add(time)
+            if self.threshold is not None and time >= self.threshold:
+                self.over[(name, key)] += 1
+
+    def merge(self, other):
+        for name in self.groups:
+            mine = getattr(self, name)
+            for key, hist in getattr(other, name).items():
+                mine[key].merge(hist)
+        self.over.update(other.over)
+
+    def dump(self):
+        for title, name in (('API', 'by_api'), ('Tenant', 'by_tenant'),
+                            ('Minute', 'by_minute')):
+            groups = getattr(self, name)
+            if name == 'by_minute':
+                keys = sorted(groups)
+            else:
+                keys = sorted(groups, key=lambda k: -groups[k].count)
+            columns = (['count'] + ['p%d' % p for p in REPORT_PERCENTILES]
+                       + ['max'])
+            if self.threshold is not None:
+                columns.append('>=%s' % self.threshold)
+            print('====================================')
+            print('%-40s ' % title + ' '.join('%9s' % c for c in columns))
+            for key in keys:
+                hist = groups[key]
+                values = ['%9d' % hist.count]
+                values.extend('%9.3f' % hist.percentile(p)
+                              for p in REPORT_PERCENTILES)
+                values.append('%9.3f' % hist.max)
+                if self.threshold is not None:
+                    values.append('%9d' % self.over[(name, key)])
+                print('%-40s ' % key + ' '.join(values))
+            print('====================================\n')
+
+
+def _report_chunk(args):
+    file_path, start, end, search_str, threshold = args
+    report = LatencyReport(threshold)
+    for line in _read_lines(file_path, start, end):
+        report.add_line(line, search_str)
+    return report
+
+
+def latency_report(search_str=None, threshold=None, file_paths=None,
+                   workers=None, chunk_size=CHUNK_SIZE):
+    """Build a LatencyReport over the wsgi lines matching search_str."""
+    report = LatencyReport(threshold)
+    for chunk_report in _imap_chunks(_report_chunk, file_paths or [],
+                                     (search_str, threshold), workers=workers,
+                                     chunk_size=chunk_size):
+        report.merge(chunk_report)
+    return report
+
+
+def _export_chunk(args):
+    file_path, start, end = args
+    rows = []
+    pos = start
+    with _open_log(file_path) as f:
+        if start:
+            f.seek(start)
+        for raw in f:
+            if end is not None and pos >= end:
+                break
+            if not raw.endswith(b'\n'):
+                # last line is still being written
+                break
+            pos += len(raw)
+            parts = raw.decode('utf-8', 'replace').rstrip('\n').split(' ')
+            req_id = _get_request_id(parts)
+            if not req_id:
+                continue
+            time = _get_completion_time(parts)
+            if time is None:
+                continue
+            try:
+                req_uuid = uuid.UUID(req_id[4:]).bytes
+            except ValueError:
+                req_uuid = b'\0' * 16
+            dt = _parse_timestamp(' '.join(parts[:3]))
+            timestamp = (calendar.timegm(dt.timetuple())
+                         + dt.microsecond / 1000000.0)
+            rows.append((req_uuid, timestamp, time, parts[7].rstrip(']'),
+                         parts[6], _normalize_api(parts)))
+    return file_path, rows, pos
+
+
+def _complete_size(file_path):
+    # size of the file up to its last complete line
+    size = os.path.getsize(file_path)
+    with open(file_path, 'rb') as f:
+        pos = size
+        while pos > 0:
+            step = min(pos, 64 * 1024)
+            pos -= step
+            f.seek(pos)
+            newline = f.read(step).rfind(b'\n')
+            if newline >= 0:
+                return pos + newline + 1
+    return 0
+
+
+def _load_export_meta(out_dir):
+    try:
+        with open(os.path.join(out_dir, 'meta.json')) as f:
+            meta = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    if (meta.get('version') != EXPORT_VERSION
+            or meta.get('byteorder') != sys.byteorder):
+        return None
+    return meta
+
+
+def export_requests(file_paths, out_dir, workers=None, chunk_size=CHUNK_SIZE):
+    """Append the wsgi request summaries of the logs to a columnar store.
+
+    out_dir holds one raw file per EXPORT_COLUMNS entry, strings.txt with
+    the interned tenant, user and API strings, and meta.json. Logs are
+    recognized by their first line, so a log exported earlier (even after
+    being rotated or compressed) only has its new lines appended. Returns
+    the number of rows added.
+    """
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    meta = _load_export_meta(out_dir)
+    if meta is None:
+        meta = {'version': EXPORT_VERSION, 'byteorder': sys.byteorder,
+                'rows': 0, 'strings': 0, 'sources': {}}
+    # drop whatever an interrupted export appended after the last meta.json
+    for name, code in EXPORT_COLUMNS.items():
+        path = os.path.join(out_dir, name + '.col')
+        itemsize = array.array(code).itemsize
+        if name == 'request_id':
+            itemsize *= 16
+        with open(path, 'ab') as f:
+            f.truncate(meta['rows'] * itemsize)
+    strings = []
+    with open(os.path.join(out_dir, 'strings.txt'), 'ab+') as f:
+        f.seek(0)
+        for line in f:
+            if len(strings) == meta['strings']:
+                break
+            strings.append(line.rstrip(b'\n').decode('utf-8'))
+        f.truncate(sum(len(string.encode('utf-8')) + 1
+                       for string in strings))
+    codes = dict((string, code) for code, string in enumerate(strings))
+    new_strings = []
+
+    def intern(string):
+        code = codes.get(string)
+        if code is None:
+            code = codes[string] = len(codes)
+            new_strings.append(string)
+        return code
+
+    tasks = []
+    keys = {}
+    for file_path in file_paths:
+        with _open_log(file_path) as f:
+            key = hashlib.md5(f.readline()).hexdigest()
+        start = meta['sources'].get(key, 0)
+        if file_path.endswith('.gz'):
+            tasks.append((file_path, start, None))
+        else:
+            size = _complete_size(file_path)
+            if size <= start:
+                continue
+            tasks.append((file_path, start, size))
+        keys[file_path] = key
+    columns = dict((name, array.array(code))
+                   for name, code in EXPORT_COLUMNS.items())
+    # array.frombytes() is called fromstring() on Python 2
+    add_request_id = (getattr(columns['request_id'], 'frombytes', None) or
+                      columns['request_id'].fromstring)
+    results = _imap_chunks(_export_chunk, tasks, (), workers=workers,
+                           chunk_size=chunk_size)
+    added = 0
+    for file_path, rows, end in results:
+        for req_uuid, timestamp, time, tenant_id, user_id, api in rows:
+            add_request_id(req_uuid)
+            columns['timestamp'].append(timestamp)
+            columns['time'].append(time)
+            columns['tenant_id'].append(intern(tenant_id))
+            columns['user_id'].append(intern(user_id))
+            columns['api'].append(intern(api))
+        added += len(rows)
+        key = keys[file_path]
+        meta['sources'][key] = max(meta['sources'].get(key, 0), end)
+    if not added and not tasks:
+        return 0
+    for name, column in columns.items():
+        with open(os.path.join(out_dir, name + '.col'), 'ab') as f:
+            column.tofile(f)
+    with open(os.path.join(out_dir, 'strings.txt'), 'ab') as f:
+        for string in new_strings:
+            f.write(string.encode('utf-8') + b'\n')
+    meta['rows'] += added
+    meta['strings'] = len(codes)
+    tmp_path = os.path.join(out_dir, 'meta.json.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(meta, f)
+    os.rename(tmp_path, os.path.join(out_dir, 'meta.json'))
+    return added
+
+
+def load_requests(out_dir):
+    """Load a store written by export_requests().
+
+    Returns (columns, strings): numpy memmaps (request_id as 16 byte
+    strings) when numpy is installed, array.array columns otherwise, and
+    the list decoding tenant_id, user_id and api codes.
+    """
+    meta = _load_export_meta(out_dir)
+    if meta is None:
+        raise ValueError('%s is not a request export' % out_dir)
+    rows = meta['rows']
+    columns = {}
+    for name, code in EXPORT_COLUMNS.items():
+        path = os.path.join(out_dir, name + '.col')
+        if numpy is not None:
+            dtype = 'S16' if name == 'request_id' else code
+            if rows:
+                columns[name] = numpy.memmap(path, dtype=dtype, mode='r',
+                                             shape=(rows,))
+            else:
+                columns[name] = numpy.empty(0, dtype=dtype)
+        else:
+            column = array.array(code)
+            count = rows * 16 if name == 'request_id' else rows
+            with open(path, 'rb') as f:
+                column.fromfile(f, count)
+            columns[name] = column
+    strings = []
+    with open(os.path.join(out_dir, 'strings.txt'), 'rb') as f:
+        for line in f:
+            if len(strings) == meta['strings']:
+                break
+            strings.append(line.rstrip(b'\n').decode('utf-8'))
+    return columns, strings
+
+
+class Inotify(object):
+    """Minimal ctypes binding of Linux inotify watching one directory."""
+    IN_MODIFY = 0x00000002
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_CLOEXEC = 0o2000000
+    _event = struct.Struct('iIII')
+
+    def __init__(self, directory):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = libc.inotify_init1(self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        mask = (self.IN_MODIFY | self.IN_MOVED_FROM | self.IN_MOVED_TO
+                | self.IN_CREATE | self.IN_DELETE)
+        path = os.path.abspath(directory).encode()
+        if libc.inotify_add_watch(self.fd, path, mask) < 0:
+            os.close(self.fd)
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch failed')
+
+    def wait(self, name):
+        """Block until an event about file name in the directory arrives."""
+        name = name.encode()
+        while True:
+            data = os.read(self.fd, 64 * 1024)
+            pos = 0
+            while pos < len(data):
+                wd, mask, cookie, length = self._event.unpack_from(data, pos)
+                pos += self._event.size
+                event_name = data[pos:pos + length].rstrip(b'\0')
+                pos += length
+                if event_name == name:
+                    return
+
+    def close(self):
+        os.close(self.fd)
+
+
+def follow_slow_requests(search_str=None, threshold=1.0, file_path=None,
+                         from_start=False, max_pending=MAX_PENDING_REQUESTS,
+                         max_lines=MAX_LINES_PER_REQUEST, patterns=None):
+    """Tail file_path like tail -F and yield (info, logs) of slow requests.
+
+    The process sleeps in inotify until the log directory reports a change
+    to the file, then reads everything appended at once. A rotated
+    (renamed or recreated) log is drained before the new file is opened
+    from its start, and a truncated log is reread from its start. Without
+    inotify the file is polled every FOLLOW_POLL_INTERVAL seconds.
+    """
+    matcher = _get_matcher(search_str, threshold, patterns)
+    if not matcher or not file_path:
+        return
+    try:
+        notifier = Inotify(os.path.dirname(file_path) or '.')
+    except (OSError, AttributeError):
+        notifier = None
+    name = os.path.basename(file_path)
+    pending = collections.OrderedDict()
+    f = open(file_path, 'rb')
+    if not from_start:
+        f.seek(0, os.SEEK_END)
+    rest = b''
+    try:
+        while True:
+            data = f.read(FOLLOW_READ_SIZE)
+            if data:
+                lines = (rest + data).split(b'\n')
+                rest = lines.pop()
+                lines = [line.decode('utf-8', 'replace') for line in lines]
+                for item in _scan_lines(lines, matcher, pending,
+                                        max_pending, max_lines):
+                    yield item
+                if len(data) == FOLLOW_READ_SIZE:
+                    continue
+            try:
+                stat = os.stat(file_path)
+            except OSError:
+                stat = None
+            if stat and stat.st_ino != os.fstat(f.fileno()).st_ino:
+                # rotated, the old file has been drained above
+                f.close()
+                f = open(file_path, 'rb')
+                rest = b''
+                continue
+            if stat and stat.st_size < f.tell():
+                # truncated in place (copytruncate)
+                f.seek(0)
+                rest = b''
+                continue
+            if notifier:
+                notifier.wait(name)
+            else:
+                _time.sleep(FOLLOW_POLL_INTERVAL)
+    finally:
+        f.close()
+        if notifier:
+            notifier.close()
+
+
+def print_request_logs(req_id, logs, search_str, threshold):
+    parsed_logs = parse_log(logs)
+    print('====================================')
+    print("API: %s with threshold %s, request_id: %s "
+          % (search_str, '>' + str(threshold), req_id))
+    for parsed_log in parsed_logs:
+        print_parsed_log(parsed_log)
+    print('====================================\n\n')
+
+
 def test():
     path = '/home/ubuntu/neutron-server.log.2'
     reqs = filter_requests(
@@ -108,25 +1136,213 @@ def test():
         print('====================================\n\n')
 
 
-def main(search_str, threshold, file_path):
-    reqs = filter_requests(search_str, threshold, file_path)
-    req_ids = [req['request_id'] for req in reqs]
-    all_logs = get_logs_by_request_ids(req_ids, file_path)
-    for req_id, logs in all_logs.items():
-        parsed_logs = parse_log(logs)
+def message_template(content):
+    """Strip uuids, hex ids and numbers (and IPs) out of a log message."""
+    return TEMPLATE_PATTERN.sub('#', content)
+
+
+class GapReport(object):
+    """Time spent after each message template in request timelines.
+
+    Every gap between two consecutive lines of a request is charged to the
+    template of the line opening it, which points at the log site right
+    before a stall (a DB lock wait, an RPC call to an agent, ...).
+    """
+
+    def __init__(self):
+        self.count = collections.Counter()
+        self.total = collections.Counter()
+        self.max = {}
+        self.requests = 0
+
+    def add(self, logs):
+        self.requests += 1
+        prev = None
+        for record in parse_log(logs):
+            if prev is not None:
+                gap = (record.datetime - prev.datetime).total_seconds()
+                key = prev.code + ' ' + message_template(prev.content)
+                self.count[key] += 1
+                self.total[key] += gap
+                if gap > self.max.get(key, -1):
+                    self.max[key] = gap
+            prev = record
+
+    def dump(self, top=GAP_REPORT_TOP):
         print('====================================')
-        print("API: %s with threshold %s, request_id: %s "
-              % (search_str, '>' + str(threshold), req_id))
-        for parsed_log in parsed_logs:
-            print_parsed_log(parsed_log)
+        print("Gaps after log sites in %d slow requests" % self.requests)
+        print('%10s %8s %9s %9s  %s' % ('total', 'count', 'avg', 'max',
+                                        'template'))
+        for key, total in self.total.most_common(top):
+            count = self.count[key]
+            print('%10.3f %8d %9.3f %9.3f  %s'
+                  % (total, count, total / count, self.max[key], key))
+        print('====================================\n')
+
+
+def read_patterns(file_path):
+    """Read "threshold search_string" lines, e.g. "5 POST /v2.0/ports"."""
+    patterns = []
+    with open(file_path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            threshold, search_str = line.split(None, 1)
+            patterns.append((search_str, float(threshold)))
+    return patterns
+
+
+def print_matched_requests(info, logs, patterns):
+    thresholds = dict(patterns)
+    print_request_logs(info['request_id'], logs,
+                       ' | '.join(info['patterns']),
+                       ' | '.join(str(thresholds[p])
+                                  for p in info['patterns']))
+
+
+def print_pattern_summary(results, patterns):
+    for search_str, threshold in patterns:
+        infos = sorted(results.get(search_str, []),
+                       key=lambda info: -info['time'])
+        print('====================================')
+        print("API: %s with threshold %s, %d requests"
+              % (search_str, '>' + str(threshold), len(infos)))
+        for info in infos:
+            print("%10.3f %s %s %s" % (info['time'], info['request_id'],
+                                       info['tenant_id'].rstrip(']'),
+                                       info['user_id']))
         print('====================================\n\n')
 
 
+def main(search_str, threshold, file_paths, workers=None, use_index=False,
+         report=False, follow=False, patterns=None, gaps=None,
+         host_files=None):
+    if not patterns:
+        patterns = [(search_str, threshold)]
+    if follow:
+        for info, logs in follow_slow_requests(file_path=file_paths[0],
+                                               patterns=patterns):
+            print_matched_requests(info, logs, patterns)
+            sys.stdout.flush()
+        return
+    if report:
+        latency_report(search_str, threshold, file_paths,
+                       workers=workers).dump()
+        return
+    if host_files:
+        results = scan_merged_requests(host_files=host_files,
+                                       patterns=patterns)
+    elif use_index:
+        # gzip files cannot be seeked, they are always scanned
+        gz_paths = [path for path in file_paths if path.endswith('.gz')]
+        results = [scan_slow_requests(file_paths=gz_paths, workers=workers,
+                                      patterns=patterns)]
+        for path in file_paths:
+            if path not in gz_paths:
+                results.append(query_index(file_path=path,
+                                           patterns=patterns))
+        results = itertools.chain(*results)
+    else:
+        results = scan_slow_requests(file_paths=file_paths, workers=workers,
+                                     patterns=patterns)
+    if gaps:
+        gap_report = GapReport()
+        for info, logs in results:
+            gap_report.add(logs)
+        gap_report.dump(gaps)
+        return
+    grouped = collections.defaultdict(list)
+    for info, logs in results:
+        print_matched_requests(info, logs, patterns)
+        for search_str in info['patterns']:
+            grouped[search_str].append(info)
+    if len(patterns) > 1:
+        print_pattern_summary(grouped, patterns)
+
+
 if __name__ == '__main__':
-    if len(sys.argv) != 4:
-        print("Usage: %s search_string threshold log_file" % sys.argv[0])
-        sys.exit(1)
-    search_str = sys.argv[1]
-    threshold = float(sys.argv[2])
-    file_path = sys.argv[3]
-    main(search_str, threshold, file_path)
+    parser = argparse.ArgumentParser(
+        description='Print the logs of API requests slower than threshold',
+        usage='%(prog)s [options] search_string threshold log_file [...]\n'
+              '       %(prog)s [options] -e search_string threshold [-e ...] '
+              'log_file [...]')
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help='number of worker processes (default: ncpu)')
+    parser.add_argument('-r', '--rotated', action='store_true',
+                        help='also read rotated logs: log_file.N[.gz]')
+    parser.add_argument('-i', '--index', action='store_true',
+                        help='build/update log_file%s and query through it'
+                        % INDEX_SUFFIX)
+    parser.add_argument('-p', '--report', action='store_true',
+                        help='print latency percentiles per API, tenant and '
+                        'minute instead, counting requests over threshold; '
+                        'an empty search_string matches every request')
+    parser.add_argument('-f', '--follow', action='store_true',
+                        help='follow the growing log_file across rotations')
+    parser.add_argument('-g', '--gaps', type=int, nargs='?', metavar='TOP',
+                        const=GAP_REPORT_TOP,
+                        help='rank the log sites before the largest gaps in '
+                        'the slow requests instead of printing them')
+    parser.add_argument('-x', '--export', metavar='OUT_DIR',
+                        help='append the request summaries of the log files '
+                        'to a columnar store in OUT_DIR; then only log files '
+                        'are given')
+    parser.add_argument('-e', '--pattern', nargs=2, action='append',
+                        metavar=('SEARCH_STRING', 'THRESHOLD'),
+                        help='search several APIs in one pass, may be '
+                        'repeated; then only log files are given')
+    parser.add_argument('-m', '--pattern-file',
+                        help='read "threshold search_string" lines')
+    parser.add_argument('-H', '--host', action='append',
+                        metavar='HOST=LOG_FILE',
+                        help='merge the logs of several hosts by time, may be '
+                        'repeated; then no log_file is given')
+    parser.add_argument('args', nargs='*', metavar='arg',
+                        help='search_string threshold log_file [...], log '
+                        'files may be globs and gzip compressed')
+    args = parser.parse_args()
+    patterns = []
+    for search_str, threshold in args.pattern or []:
+        patterns.append((search_str, float(threshold)))
+    if args.pattern_file:
+        patterns.extend(read_patterns(args.pattern_file))
+    if args.export:
+        file_paths = expand_log_files(args.args, rotated=args.rotated)
+        print('%d requests exported'
+              % export_requests(file_paths, args.export,
+                                workers=args.workers))
+        sys.exit(0)
+    if patterns and args.report:
+        parser.error('--report takes a single search_string threshold')
+    elif patterns:
+        args.search_string = None
+        args.threshold = None
+        args.log_file = args.args
+    elif len(args.args) < (2 if args.host else 3):
+        parser.error('search_string threshold log_file are required')
+    else:
+        args.search_string = args.args[0]
+        args.threshold = float(args.args[1])
+        args.log_file = args.args[2:]
+    host_files = []
+    if args.host:
+        if args.log_file:
+            parser.error('log files are given with --host HOST=LOG_FILE')
+        if args.follow or args.report or args.index:
+            parser.error('--host only works with the search modes')
+        for host_file in args.host:
+            host, _, pattern = host_file.partition('=')
+            host_files.append(
+                (host, expand_log_files([pattern], rotated=args.rotated)))
+    elif not args.log_file:
+        parser.error('log_file is required')
+    if args.follow and len(args.log_file) != 1:
+        parser.error('--follow takes exactly one log_file')
+    if args.follow:
+        file_paths = args.log_file
+    else:
+        file_paths = expand_log_files(args.log_file, rotated=args.rotated)
+    main(args.search_string, args.threshold, file_paths, workers=args.workers,
+         use_index=args.index, report=args.report, follow=args.follow,
+         patterns=patterns, gaps=args.gaps, host_files=host_files)
@@ -1,14 +1,60 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
+import argparse
+import bisect
+import collections
+import heapq
+import multiprocessing.pool
+import shlex
+import socket
+import struct
 import sys
 import subprocess
+import time
 
 
-cur_table = None
-all_chains = {}
-top_chains = {}
-tables = {}
+IPTABLES_SAVE_CMD = "sudo iptables-save -c"
+# samples kept per rule by RuleSampler and rows printed
+SAMPLE_WINDOW = 12
+SAMPLE_TOP = 20
+# targets ending the walk of a chain, and those ending the whole traversal
+STOP_TARGETS = frozenset(['ACCEPT', 'DROP', 'REJECT', 'RETURN', 'QUEUE',
+                          'SNAT', 'DNAT', 'MASQUERADE', 'REDIRECT'])
+FINAL_TARGETS = STOP_TARGETS - frozenset(['RETURN'])
+# rules which may be reordered among each other by suggest_reorder()
+MOVABLE_TARGETS = frozenset(['ACCEPT', 'RETURN'])
+# chains shorter than this are matched rule by rule by the Classifier
+INDEX_MIN_RULES = 8
+PROTOCOLS = {'1': 'icmp', '6': 'tcp', '17': 'udp', '58': 'ipv6-icmp',
+             '132': 'sctp'}
+
+SSH_IPTABLES_SAVE_CMD = "ssh %s sudo iptables-save -c"
+# hosts dumped at the same time by parse_hosts()
+HOST_WORKERS = 16
+
+
+class Rule(object):
+    """A rule of a chain, its condition is parsed on first use.
+
+    jump is '-j', or '-g' for a goto which does not return to its chain.
+    """
+    __slots__ = ('cond', 'target', 'packet', 'byte', 'jump', '_fields')
+
+    def __init__(self, cond, target, packet, byte, jump='-j'):
+        self.cond = cond
+        self.target = target
+        self.packet = packet
+        self.byte = byte
+        self.jump = jump
+        self._fields = None
+
+    @property
+    def fields(self):
+        """The condition parsed by parse_cond()."""
+        if self._fields is None:
+            self._fields = parse_cond(self.cond)
+        return self._fields
 
 
 class Chain(object):
@@ -19,6 +65,8 @@ class Chain(object):
         self.packet = int(packet)
         self.byte = int(byte)
         self.rules = []
+        self._expanded = None
+        self._visiting = False
 
     def __repr__(self):
         return "%s(%s)" % (self.__class__, self.name)
@@ -27,95 +75,981 @@ class Chain(object):
         return ("%s %s [%d:%d]"
                 % (self.name, self.policy, self.packet, self.byte))
 
-    def add_rule(self, cond, target, pkt, byte):
-        self.rules.append((cond, target, pkt, byte))
+    def add_rule(self, cond, target, pkt, byte, jump='-j'):
+        self.rules.append(Rule(cond, target, pkt, byte, jump))
+
+    def expanded_rules(self):
+        """Number of rules printed if every jump was expanded inline."""
+        return self._expand()[0]
+
+    def expanded_counters(self):
+        """(packets, bytes) summed over the rules of expanded_rules()."""
+        return self._expand()[1:]
+
+    def _expand(self):
+        # (rules, packets, bytes) of the chain with its jumps expanded,
+        # computed iteratively in post order and memoized on every chain,
+        # so shared chains are only counted once
+        stack = [self]
+        while stack:
+            chain = stack[-1]
+            if chain._expanded is not None:
+                stack.pop()
+                continue
+            todo = [rule.target for rule in chain.rules
+                    if isinstance(rule.target, Chain)
+                    and rule.target._expanded is None]
+            if todo and not chain._visiting:
+                chain._visiting = True
+                stack.extend(todo)
+                continue
+            chain._visiting = False
+            rules = packets = nbytes = 0
+            for rule in chain.rules:
+                rules += 1
+                packets += rule.packet
+                nbytes += rule.byte
+                if isinstance(rule.target, Chain) and rule.target._expanded:
+                    rules += rule.target._expanded[0]
+                    packets += rule.target._expanded[1]
+                    nbytes += rule.target._expanded[2]
+            chain._expanded = (rules, packets, nbytes)
+            stack.pop()
+        return self._expanded
 
-    def pretty_print(self, indent=''):
-        for cond, target, pkt, byte in self.rules:
+    def pretty_print(self, indent='', shown=None, out=None):
+        """Print the rules, expanding each target chain only once.
+
+        Chains in shown (all chains printed so far) are referenced instead
+        of being printed again; pass the same set for every top chain of a
+        table to render the chain graph as a DAG.
+        """
+        if shown is None:
+            shown = set()
+        if out is None:
+            out = sys.stdout
+        shown.add(self)
+        stack = [(self, 0, indent)]
+        while stack:
+            chain, index, indent = stack.pop()
+            if index >= len(chain.rules):
+                continue
+            rule = chain.rules[index]
+            target = rule.target
+            stack.append((chain, index + 1, indent))
             if isinstance(target, Chain):
-                print(indent + "-A %s %s -j %s\t[%d:%d]"
-                      % (self.name, cond, target.name, pkt, byte))
-                target.pretty_print(indent + '  ')
+                out.write(indent + "-A %s %s %s %s\t[%d:%d]\n"
+                          % (chain.name, rule.cond, rule.jump, target.name,
+                             rule.packet, rule.byte))
+                if target in shown:
+                    out.write(indent + "  ... %s shown above, %d rules"
+                              "\t[%d:%d]\n"
+                              % ((target.name, target.expanded_rules())
+                                 + target.expanded_counters()))
+                else:
+                    shown.add(target)
+                    stack.append((target, 0, indent + '  '))
             else:
-                print(indent + "-A %s %s -j %s\t[%d:%d]"
-                      % (self.name, cond, target, pkt, byte))
+                out.write(indent + "-A %s %s %s %s\t[%d:%d]\n"
+                          % (chain.name, rule.cond, rule.jump, target,
+                             rule.packet, rule.byte))
 
 
-def parse_line(line):
-    if not line:
-        return
-    c = line[0:1]
-    if c == '#':
-        # comment
-        pass
-    elif c == '*':
-        # table
-        global cur_table
-        cur_table = line[1:].strip()
-    elif c == ':':
-        # chain
-        parts = line[1:].split()
-        chain = parts[0]
-        policy = parts[1]
-        counts = parts[2][1:-1].split(':')
-        chain_obj = Chain(**{'name': chain, 'policy': policy,
-                          'table': cur_table,
-                          'packet': counts[0], 'byte': counts[1]})
-        key = cur_table + ":" + chain
-        all_chains[key] = chain_obj
-        top_chains[key] = chain_obj
-
-    elif c == '[':
-        # rules
-        parts = line.split()
-        counts = parts[0][1:-1].split(':')
-        chain_name = parts[2]
-        key = cur_table + ":" + chain_name
-        if key not in all_chains:
-            print("Error: unknown chain %s" % chain_name)
+class IptablesParser(object):
+    """Parse one iptables-save -c dump, line by line.
+
+    All state lives in the instance, so several dumps can be parsed at
+    the same time (see parse_hosts()). all_chains maps "table:chain" to
+    every Chain, top_chains those no rule jumps to, and tables (filled by
+    group_results()) the top chains per table.
+    """
+
+    def __init__(self):
+        self.cur_table = None
+        self.all_chains = {}
+        self.top_chains = {}
+        self.tables = {}
+
+    def reset(self):
+        self.cur_table = None
+        self.all_chains.clear()
+        self.top_chains.clear()
+        self.tables.clear()
+
+    def parse_line(self, line):
+        if not line:
             return
-        chain = all_chains[key]
-        remain_parts = ' '.join(parts[3:]).split('-j')
-        cond = remain_parts[0].strip()
-        target = remain_parts[1].strip()
-
-        if target.split()[0] in ['SNAT', 'DNAT', 'ACCEPT', 'DROP',
-                                 'MASQUERADE', 'CHECKSUM', 'QUEUE',
-                                 'MARK', 'RETURN', 'REJECT', 'LOG',
-                                 'REDIRECT']:
-            chain.add_rule(cond, target, int(counts[0]), int(counts[1]))
-        else:
-            key = cur_table + ":" + target.split()[0]
-            chain.add_rule(cond, all_chains[key],
-                           int(counts[0]), int(counts[1]))
-            if key in top_chains:
-                del top_chains[key]
+        c = line[0:1]
+        if c == '#':
+            # comment
+            pass
+        elif c == '*':
+            # table
+            self.cur_table = line[1:].strip()
+        elif c == ':':
+            # chain
+            parts = line[1:].split()
+            chain = parts[0]
+            counts = parts[2][1:-1].split(':')
+            chain_obj = Chain(name=chain, policy=parts[1],
+                              table=self.cur_table,
+                              packet=counts[0], byte=counts[1])
+            key = self.cur_table + ":" + chain
+            self.all_chains[key] = chain_obj
+            self.top_chains[key] = chain_obj
+        elif c == '[':
+            # rules: [pkt:byte] -A chain cond... -j target...
+            parts = line.split()
+            counts = parts[0][1:-1].split(':')
+            chain_name = parts[2]
+            key = self.cur_table + ":" + chain_name
+            chain = self.all_chains.get(key)
+            if chain is None:
+                print("Error: unknown chain %s" % chain_name)
+                return
+            jump = len(parts)
+            for index in range(3, len(parts)):
+                if parts[index] in ('-j', '-g'):
+                    jump = index
+                    break
+            cond = ' '.join(parts[3:jump])
+            target = ' '.join(parts[jump + 1:])
+            jump = parts[jump] if jump < len(parts) else '-j'
+            key = self.cur_table + ":" + target.split(' ', 1)[0]
+            target_chain = self.all_chains.get(key)
+            if target_chain is not None:
+                target = target_chain
+                self.top_chains.pop(key, None)
+            chain.add_rule(cond, target, int(counts[0]), int(counts[1]),
+                           jump)
+
+    def parse(self, lines):
+        for line in lines:
+            self.parse_line(line)
+        self.group_results()
+        return self
+
+    def parse_command(self, command=IPTABLES_SAVE_CMD):
+        """Parse the output of command as it is produced."""
+        popen = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE,
+                                 universal_newlines=True)
+        try:
+            self.parse(popen.stdout)
+        finally:
+            popen.stdout.close()
+            returncode = popen.wait()
+        if returncode:
+            raise subprocess.CalledProcessError(returncode, command)
+        return self
+
+    def group_results(self):
+        self.tables.clear()
+        for key in self.top_chains:
+            tbl = key.split(":")[0]
+            if tbl in self.tables:
+                self.tables[tbl].append(self.top_chains[key])
+            else:
+                self.tables[tbl] = [self.top_chains[key]]
+
+    def pretty_print(self):
+        for tbl in self.tables:
+            print("-t %s" % tbl)
+            shown = set()
+            for chain in self.tables[tbl]:
+                print("%s\t[%d:%d]" % (chain.name, chain.packet, chain.byte))
+                chain.pretty_print('  ', shown)
+            print('')
+
+
+def parse_hosts(hosts, command=SSH_IPTABLES_SAVE_CMD, workers=HOST_WORKERS):
+    """Dump and parse the rules of many hosts concurrently.
+
+    command is formatted with each host. Returns {host: IptablesParser},
+    or the exception for the hosts that failed.
+    """
+    def _parse(host):
+        try:
+            return host, IptablesParser().parse_command(command % host)
+        except Exception as e:
+            return host, e
+
+    pool = multiprocessing.pool.ThreadPool(min(workers, len(hosts)) or 1)
+    try:
+        return dict(pool.map(_parse, hosts))
+    finally:
+        pool.close()
+
+
+# module level parser kept for the function interface
+_parser = IptablesParser()
+all_chains = _parser.all_chains
+top_chains = _parser.top_chains
+tables = _parser.tables
+
+
+def parse_line(line):
+    _parser.parse_line(line)
 
 
 def group_results():
-    for key in top_chains:
-        tbl = key.split(":")[0]
-        if tbl in tables:
-            tables[tbl].append(top_chains[key])
+    _parser.group_results()
+
+
+def _parse_addr(text):
+    # "10.0.0.0/8" -> (family, first, last) as integers
+    addr, _, prefix = text.partition('/')
+    family = socket.AF_INET6 if ':' in addr else socket.AF_INET
+    packed = socket.inet_pton(family, addr)
+    bits = len(packed) * 8
+    value = 0
+    for word in struct.unpack('!%dI' % (len(packed) // 4), packed):
+        value = (value << 32) | word
+    if not prefix:
+        prefix = bits
+    elif '.' in prefix:
+        # dotted netmask
+        mask = _parse_addr(prefix)[1]
+        prefix = bin(mask).count('1')
+    host_bits = bits - int(prefix)
+    first = value >> host_bits << host_bits
+    return (family, first, first | ((1 << host_bits) - 1))
+
+
+def _parse_ports(text):
+    ranges = []
+    for item in text.split(','):
+        first, sep, last = item.partition(':')
+        first = int(first) if first else 0
+        last = int(last) if last else (65535 if sep else first)
+        ranges.append((first, last))
+    return ranges
+
+
+_OPTIONS = {
+    '-s': 'src', '--source': 'src', '--src': 'src',
+    '-d': 'dst', '--destination': 'dst', '--dst': 'dst',
+    '-p': 'proto', '--protocol': 'proto',
+    '-i': 'in', '--in-interface': 'in',
+    '-o': 'out', '--out-interface': 'out',
+    '--sport': 'sport', '--source-port': 'sport', '--sports': 'sport',
+    '--source-ports': 'sport',
+    '--dport': 'dport', '--destination-port': 'dport', '--dports': 'dport',
+    '--destination-ports': 'dport',
+    '--physdev-in': 'physdev_in', '--physdev-out': 'physdev_out',
+    '--state': 'state', '--ctstate': 'state',
+}
+_FLAGS = frozenset(['--physdev-is-bridged', '--physdev-is-in',
+                    '--physdev-is-out'])
+
+
+def parse_cond(cond):
+    """Parse a rule condition into {field: (negated, value)}.
+
+    Fields are src/dst ((family, first, last)), proto, in/out and
+    physdev_in/physdev_out (interface names, '+' suffix as wildcard),
+    sport/dport (lists of (first, last)) and state (a frozenset).
+    Matches which are not understood are listed under 'other'; modules
+    loaded with -m are only recorded in 'modules'.
+    """
+    fields = {'other': [], 'modules': []}
+    tokens = cond.split()
+    if '"' in cond or "'" in cond or '\\' in cond:
+        # quoted comments and the like
+        try:
+            tokens = shlex.split(cond)
+        except ValueError:
+            pass
+    negated = False
+    index = 0
+    while index < len(tokens):
+        token = tokens[index]
+        index += 1
+        if token == '!':
+            negated = True
+            continue
+        args = []
+        while (index < len(tokens) and tokens[index] != '!'
+               and not tokens[index].startswith('-')):
+            args.append(tokens[index])
+            index += 1
+        name = _OPTIONS.get(token)
+        value = args[0] if args else None
+        if token in ('-m', '--match'):
+            fields['modules'].append(value)
+        elif token in _FLAGS or token in ('--comment',):
+            pass
+        elif name is None or value is None:
+            fields['other'].append((negated, token, tuple(args)))
+        elif name in ('src', 'dst'):
+            fields[name] = (negated, _parse_addr(value))
+        elif name in ('sport', 'dport'):
+            fields[name] = (negated, _parse_ports(value))
+        elif name == 'state':
+            fields[name] = (negated, frozenset(value.split(',')))
         else:
-            tables[tbl] = [top_chains[key]]
+            fields[name] = (negated, value.lower() if name == 'proto'
+                            else value)
+        negated = False
+    return fields
+
+
+def _iface_disjoint(a, b):
+    if a.endswith('+') or b.endswith('+'):
+        prefix = min(a.rstrip('+'), b.rstrip('+'), key=len)
+        return not (a.startswith(prefix) and b.startswith(prefix))
+    return a != b
+
+
+def conds_disjoint(f1, f2):
+    """True when no packet can match both parsed conditions."""
+    for name in ('src', 'dst', 'proto', 'in', 'out', 'physdev_in',
+                 'physdev_out', 'sport', 'dport', 'state'):
+        if name not in f1 or name not in f2:
+            continue
+        neg1, v1 = f1[name]
+        neg2, v2 = f2[name]
+        if neg1 or neg2:
+            continue
+        if name in ('src', 'dst'):
+            if v1[0] != v2[0] or v1[2] < v2[1] or v2[2] < v1[1]:
+                return True
+        elif name == 'proto':
+            v1 = PROTOCOLS.get(v1, v1)
+            v2 = PROTOCOLS.get(v2, v2)
+            if 'all' not in (v1, v2) and v1 != v2:
+                return True
+        elif name in ('sport', 'dport'):
+            if not any(a1 <= b2 and a2 <= b1
+                       for a1, b1 in v1 for a2, b2 in v2):
+                return True
+        elif name == 'state':
+            if not v1 & v2:
+                return True
+        elif _iface_disjoint(v1, v2):
+            return True
+    return False
+
+
+def _verdict(target):
+    if isinstance(target, Chain) or not target:
+        return None
+    return target.split()[0]
+
+
+class CostModel(object):
+    """Estimate rule evaluations per packet from the rule counters.
+
+    Rules are walked in order; a packet matching rule i stops the walk of
+    its chain when the target is in STOP_TARGETS or a goto, or with the
+    share of packets a jump target chain gives a final verdict to. Packets
+    entering
+    a user chain are the packets of the rules jumping to it, a built-in
+    chain also gets its policy counter.
+    """
+
+    def __init__(self, chains):
+        self.chains = list(chains)
+        self.entering = collections.Counter()
+        for chain in self.chains:
+            for rule in chain.rules:
+                if isinstance(rule.target, Chain):
+                    self.entering[rule.target] += rule.packet
+        self._final = {}
+
+    def entered(self, chain):
+        if chain.policy != '-':
+            return chain.packet + sum(self.stops(chain))
+        return self.entering[chain]
+
+    def final_ratio(self, chain):
+        ratio = self._final.get(chain)
+        if ratio is None:
+            # guards against loops, which iptables refuses anyway
+            self._final[chain] = 0.0
+            entered = self.entered(chain)
+            final = 0.0
+            for rule in chain.rules:
+                target, pkt = rule.target, rule.packet
+                if isinstance(target, Chain):
+                    final += pkt * self.final_ratio(target)
+                elif _verdict(target) in FINAL_TARGETS:
+                    final += pkt
+            ratio = min(1.0, final / entered) if entered else 0.0
+            self._final[chain] = ratio
+        return ratio
+
+    def stops(self, chain, rules=None):
+        stops = []
+        for rule in (chain.rules if rules is None else rules):
+            target, pkt = rule.target, rule.packet
+            if isinstance(target, Chain) and rule.jump == '-g':
+                stops.append(pkt)
+            elif isinstance(target, Chain):
+                stops.append(pkt * self.final_ratio(target))
+            elif _verdict(target) in STOP_TARGETS:
+                stops.append(pkt)
+            else:
+                stops.append(0)
+        return stops
+
+    def evaluations(self, chain, rules=None):
+        """Total rule evaluations of chain, optionally in another order."""
+        reach = float(self.entered(chain))
+        total = 0.0
+        for stop in self.stops(chain, rules):
+            if reach <= 0:
+                break
+            total += reach
+            reach -= stop
+        return total
+
+
+def suggest_reorder(chain):
+    """Return the rules of chain with hot ACCEPT/RETURN rules moved up.
+
+    Only consecutive ACCEPT/RETURN rules are reordered, and a rule only
+    passes another one with the same verdict or a disjoint condition, so
+    the verdict of every packet stays the same.
+    """
+    rules = list(chain.rules)
+    for i in range(1, len(rules)):
+        rule = rules[i]
+        if _verdict(rule.target) not in MOVABLE_TARGETS:
+            continue
+        j = i
+        while j > 0:
+            prev = rules[j - 1]
+            verdict = _verdict(prev.target)
+            if verdict not in MOVABLE_TARGETS or prev.packet >= rule.packet:
+                break
+            if (verdict != _verdict(rule.target)
+                    and not conds_disjoint(prev.fields, rule.fields)):
+                break
+            rules[j] = prev
+            j -= 1
+        rules[j] = rule
+    return rules
+
+
+def analyze_rule_order(chains, top=SAMPLE_TOP):
+    """Print the chains where reordering saves most rule evaluations."""
+    model = CostModel(chains)
+    results = []
+    for chain in chains:
+        entered = model.entered(chain)
+        if len(chain.rules) < 2 or not entered:
+            continue
+        current = model.evaluations(chain)
+        rules = suggest_reorder(chain)
+        suggested = model.evaluations(chain, rules)
+        results.append((current - suggested, chain, entered, current,
+                        suggested, rules))
+    results.sort(key=lambda item: item[0], reverse=True)
+    for saved, chain, entered, current, suggested, rules in results[:top]:
+        print("-t %s %s: %d rules, %d pkts, %.2f evaluations/pkt"
+              % (chain.table, chain.name, len(chain.rules), entered,
+                 current / entered))
+        if saved <= 0:
+            print("  no semantics preserving reorder found\n")
+            continue
+        print("  suggested order: %.2f evaluations/pkt, saves %.1f%%"
+              % (suggested / entered, 100.0 * saved / current))
+        position = dict((id(rule), pos) for pos, rule in
+                        enumerate(chain.rules))
+        moves = 0
+        for pos, rule in enumerate(rules):
+            old = position[id(rule)]
+            if old > pos and moves < 10:
+                print("  move #%d to #%d: %s %s %s\t[%d:%d]"
+                      % (old + 1, pos + 1, rule.cond, rule.jump, rule.target,
+                         rule.packet, rule.byte))
+                moves += 1
+        print('')
+
+
+class Packet(object):
+    """A test packet for the Classifier.
+
+    Addresses are (family, integer) like the values of parse_cond(),
+    missing fields are None.
+    """
+    __slots__ = ('table', 'chain', 'src', 'dst', 'proto', 'sport', 'dport',
+                 'in_iface', 'out_iface', 'physdev_in', 'physdev_out',
+                 'state')
+
+    def __init__(self, table='filter', chain=None, src=None, dst=None,
+                 proto=None, sport=None, dport=None, in_iface=None,
+                 out_iface=None, physdev_in=None, physdev_out=None,
+                 state=None):
+        self.table = table
+        self.chain = chain
+        self.src = src
+        self.dst = dst
+        self.proto = proto
+        self.sport = sport
+        self.dport = dport
+        self.in_iface = in_iface
+        self.out_iface = out_iface
+        self.physdev_in = physdev_in
+        self.physdev_out = physdev_out
+        self.state = state
+
+    @classmethod
+    def parse(cls, text):
+        """Parse "src=10.0.0.5 dst=10.0.1.3 proto=tcp dport=22 in=eth0"."""
+        kwargs = {}
+        for item in text.split():
+            key, _, value = item.partition('=')
+            key = {'in': 'in_iface', 'out': 'out_iface'}.get(key, key)
+            if key in ('src', 'dst'):
+                family, first, _ = _parse_addr(value)
+                value = (family, first)
+            elif key in ('sport', 'dport'):
+                value = int(value)
+            elif key == 'proto':
+                value = PROTOCOLS.get(value, value.lower())
+            elif key == 'state':
+                value = value.upper()
+            elif key not in cls.__slots__:
+                raise ValueError('unknown packet field %s' % key)
+            kwargs[key] = value
+        return cls(**kwargs)
+
+    def builtin_chain(self):
+        if self.chain:
+            return self.chain
+        if self.table in ('nat', 'raw'):
+            return 'PREROUTING' if self.in_iface else 'OUTPUT'
+        if self.in_iface and self.out_iface:
+            return 'FORWARD'
+        return 'INPUT' if self.in_iface else 'OUTPUT'
+
+    def __str__(self):
+        values = []
+        for name in self.__slots__:
+            value = getattr(self, name)
+            if value is None:
+                continue
+            if name in ('src', 'dst'):
+                family, addr = value
+                size = 4 if family == socket.AF_INET else 16
+                packed = b''.join(
+                    struct.pack('!I', (addr >> shift) & 0xffffffff)
+                    for shift in range(size * 8 - 32, -1, -32))
+                value = socket.inet_ntop(family, packed)
+            values.append('%s=%s' % (name, value))
+        return ' '.join(values)
+
+
+_PACKET_FIELDS = {'in': 'in_iface', 'out': 'out_iface'}
+
+
+def _iface_match(pattern, iface):
+    if pattern.endswith('+'):
+        return iface.startswith(pattern[:-1])
+    return iface == pattern
+
+
+def _field_match(name, value, packet):
+    attr = _PACKET_FIELDS.get(name, name)
+    actual = getattr(packet, attr)
+    if actual is None:
+        return False
+    if name in ('src', 'dst'):
+        return value[0] == actual[0] and value[1] <= actual[1] <= value[2]
+    if name == 'proto':
+        return value == 'all' or PROTOCOLS.get(value, value) == actual
+    if name in ('sport', 'dport'):
+        return any(first <= actual <= last for first, last in value)
+    if name == 'state':
+        return actual in value
+    return _iface_match(value, actual)
+
+
+def match_cond(fields, packet):
+    """Return (matched, certain) for parsed condition fields."""
+    for name, field in fields.items():
+        if name in ('other', 'modules'):
+            continue
+        negated, value = field
+        if _field_match(name, value, packet) == negated:
+            return False, True
+    return True, not fields['other']
+
+
+class _PrefixTrie(object):
+    """Binary trie of address prefixes mapping to rule indices."""
+
+    def __init__(self):
+        self.roots = {}
+
+    def add(self, family, first, last, value):
+        bits = 32 if family == socket.AF_INET else 128
+        length = bits - (last - first).bit_length()
+        node = self.roots.setdefault(family, [None, None, []])
+        for bit in range(length):
+            branch = (first >> (bits - 1 - bit)) & 1
+            if node[branch] is None:
+                node[branch] = [None, None, []]
+            node = node[branch]
+        node[2].append(value)
+
+    def lookup(self, family, addr):
+        # values of every prefix containing addr
+        bits = 32 if family == socket.AF_INET else 128
+        node = self.roots.get(family)
+        found = []
+        bit = 0
+        while node is not None:
+            found.extend(node[2])
+            if bit == bits:
+                break
+            node = node[(addr >> (bits - 1 - bit)) & 1]
+            bit += 1
+        return found
+
+
+class _RangeTable(object):
+    """Port ranges split into elementary segments mapping to rules."""
+
+    def __init__(self, ranges):
+        # ranges is a list of ([(first, last), ...], value)
+        bounds = set([0])
+        for port_ranges, _ in ranges:
+            for first, last in port_ranges:
+                bounds.add(first)
+                bounds.add(last + 1)
+        self.bounds = sorted(bounds)
+        self.values = [[] for _ in self.bounds]
+        for port_ranges, value in ranges:
+            for first, last in port_ranges:
+                start = bisect.bisect_left(self.bounds, first)
+                end = bisect.bisect_left(self.bounds, last + 1)
+                for segment in range(start, end):
+                    self.values[segment].append(value)
+
+    def lookup(self, port):
+        return self.values[bisect.bisect_right(self.bounds, port) - 1]
+
+
+class CompiledChain(object):
+    """Rules of a chain with their conditions parsed once.
+
+    Long chains are indexed on the fields their rules match on: a hash of
+    interface names, a prefix trie of addresses or a port range table per
+    field, each rule being indexed under one of its fields. A packet then
+    only checks the rules found in the indexes plus the rules which match
+    on none of the indexed fields.
+    """
+    INDEXABLE = ('physdev_in', 'physdev_out', 'in', 'out', 'src', 'dst',
+                 'dport', 'sport')
+
+    def __init__(self, chain):
+        self.chain = chain
+        self.rules = [(rule.fields, rule.target) for rule in chain.rules]
+        self.indexes = []
+        self.others = []
+        if len(self.rules) >= INDEX_MIN_RULES:
+            self._build_index()
+
+    def _indexed(self, fields, name):
+        field = fields.get(name)
+        if field is None or field[0]:
+            return False
+        return not (name in ('physdev_in', 'physdev_out', 'in', 'out')
+                    and field[1].endswith('+'))
+
+    def _build_index(self):
+        # greedily index rules on the most common remaining field until
+        # the rest would not be worth an index
+        remaining = list(range(len(self.rules)))
+        self.indexes = []
+        while len(remaining) >= INDEX_MIN_RULES:
+            counts = collections.Counter()
+            for pos in remaining:
+                for name in self.INDEXABLE:
+                    if self._indexed(self.rules[pos][0], name):
+                        counts[name] += 1
+            if not counts:
+                break
+            name, count = counts.most_common(1)[0]
+            if count < INDEX_MIN_RULES // 2:
+                break
+            covered = [pos for pos in remaining
+                       if self._indexed(self.rules[pos][0], name)]
+            remaining = [pos for pos in remaining
+                         if not self._indexed(self.rules[pos][0], name)]
+            self.indexes.append((name, _PACKET_FIELDS.get(name, name),
+                                 self._make_index(name, covered)))
+        self.others = remaining
+
+    def _make_index(self, name, positions):
+        if name in ('sport', 'dport'):
+            return _RangeTable([(self.rules[pos][0][name][1], pos)
+                                for pos in positions])
+        if name in ('src', 'dst'):
+            index = _PrefixTrie()
+            for pos in positions:
+                index.add(*(self.rules[pos][0][name][1] + (pos,)))
+            return index
+        index = collections.defaultdict(list)
+        for pos in positions:
+            index[self.rules[pos][0][name][1]].append(pos)
+        return index
+
+    def candidates(self, packet):
+        """Positions of the rules that may match packet, in order."""
+        if not self.indexes:
+            return range(len(self.rules))
+        found = set(self.others)
+        for name, attr, index in self.indexes:
+            value = getattr(packet, attr)
+            if value is None:
+                continue
+            elif name in ('src', 'dst'):
+                found.update(index.lookup(*value))
+            elif name in ('sport', 'dport'):
+                found.update(index.lookup(value))
+            else:
+                found.update(index.get(value, ()))
+        return sorted(found)
+
+
+class Classifier(object):
+    """Walk packets through parsed chains to find their path and verdict.
+
+    Matches that are not understood (see parse_cond()) are assumed to
+    match and flag the verdict as uncertain.
+    """
+
+    def __init__(self, chains):
+        self.chains = chains
+        self.compiled = {}
+
+    def _compile(self, chain):
+        compiled = self.compiled.get(chain)
+        if compiled is None:
+            compiled = self.compiled[chain] = CompiledChain(chain)
+        return compiled
+
+    def classify(self, packet):
+        """Return (verdict, certain, path) for packet.
+
+        path lists (chain, position, cond, jump, target) of every matched
+        rule, positions being 1-based like iptables -L --line-numbers. A
+        goto does not return to its chain: RETURN or the end of the chain
+        gone to resumes the chain which jumped to the goto's chain.
+        """
+        key = packet.table + ':' + packet.builtin_chain()
+        builtin = self.chains.get(key)
+        if builtin is None:
+            raise KeyError('unknown chain %s' % key)
+        path = []
+        certain = True
+        stack = []
+        chain = builtin
+        positions = iter(self._compile(chain).candidates(packet))
+        while True:
+            pos = next(positions, None)
+            if pos is None:
+                if not stack:
+                    return builtin.policy, certain, path
+                chain, positions = stack.pop()
+                continue
+            fields, target = self._compile(chain).rules[pos]
+            matched, sure = match_cond(fields, packet)
+            if not matched:
+                continue
+            certain = certain and sure
+            cond, jump = chain.rules[pos].cond, chain.rules[pos].jump
+            if isinstance(target, Chain):
+                path.append((chain, pos + 1, cond, jump, target.name))
+                if jump != '-g':
+                    stack.append((chain, positions))
+                chain = target
+                positions = iter(self._compile(chain).candidates(packet))
+                continue
+            path.append((chain, pos + 1, cond, jump, target))
+            verdict = _verdict(target)
+            if verdict == 'RETURN':
+                if not stack:
+                    return builtin.policy, certain, path
+                chain, positions = stack.pop()
+            elif verdict in STOP_TARGETS:
+                return target, certain, path
+
+
+def classify_packets(lines, chains):
+    """Classify one Packet.parse() description per line and print it."""
+    classifier = Classifier(chains)
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        try:
+            packet = Packet.parse(line)
+            verdict, certain, path = classifier.classify(packet)
+        except (KeyError, ValueError, socket.error) as e:
+            # report the packet and go on with the others
+            print("%s\n  Error: %s\n" % (line, e.args[0] if e.args else e))
+            continue
+        print(packet)
+        for chain, pos, cond, jump, target in path:
+            print("  -A %s #%d %s %s %s" % (chain.name, pos, cond, jump,
+                                           target))
+        print("  => %s%s\n" % (verdict, '' if certain else
+                                ' (assuming unknown matches match)'))
+
+
+def reset():
+    _parser.reset()
+
+
+def take_snapshot(parser):
+    """Return {rule key: (packets, bytes)} of a parsed dump.
+
+    A rule is keyed by (table, chain, position, condition, target) so the
+    same rule is matched across dumps as long as its chain keeps its order.
+    """
+    counters = {}
+    for chain in parser.all_chains.values():
+        for pos, rule in enumerate(chain.rules):
+            target = rule.target
+            if isinstance(target, Chain):
+                target = target.name
+            key = (chain.table, chain.name, pos, rule.cond, target)
+            counters[key] = (rule.packet, rule.byte)
+    return counters
+
+
+class RuleSampler(object):
+    """Ring buffers of per rule packet and byte rates between snapshots."""
+
+    def __init__(self, window=SAMPLE_WINDOW):
+        self.window = window
+        self.rates = {}
+        self.last = None
+        self.last_time = None
+
+    def add(self, counters, timestamp):
+        if self.last is not None:
+            interval = timestamp - self.last_time
+            rates = {}
+            for key, (pkt, byte) in counters.items():
+                prev = self.last.get(key)
+                if prev is None or interval <= 0:
+                    continue
+                if pkt < prev[0] or byte < prev[1]:
+                    # counters were zeroed, count from zero
+                    prev = (0, 0)
+                history = self.rates.get(key)
+                if history is None:
+                    history = collections.deque(maxlen=self.window)
+                history.append(((pkt - prev[0]) / interval,
+                                (byte - prev[1]) / interval))
+                rates[key] = history
+            # forget the rules which are gone
+            self.rates = rates
+        self.last = counters
+        self.last_time = timestamp
+
+    def _average(self, history):
+        size = float(len(history))
+        return (sum(h[0] for h in history) / size,
+                sum(h[1] for h in history) / size)
+
+    def top_rules(self, top=SAMPLE_TOP):
+        averages = ((self._average(history), key)
+                    for key, history in self.rates.items())
+        return heapq.nlargest(top, averages, key=lambda item: item[0])
+
+    def top_chains(self, top=SAMPLE_TOP):
+        chains = collections.defaultdict(lambda: [0.0, 0.0])
+        for key, history in self.rates.items():
+            pps, bps = self._average(history)
+            chain = chains[(key[0], key[1])]
+            chain[0] += pps
+            chain[1] += bps
+        return heapq.nlargest(top, ((tuple(v), k) for k, v in chains.items()),
+                              key=lambda item: item[0])
+
+    def dump(self, top=SAMPLE_TOP):
+        print("%12s %14s  %s" % ('pkt/s', 'byte/s', 'chain'))
+        for (pps, bps), (table, chain) in self.top_chains(top):
+            print("%12.1f %14.1f  -t %s %s" % (pps, bps, table, chain))
+        print('')
+        print("%12s %14s  %s" % ('pkt/s', 'byte/s', 'rule'))
+        for (pps, bps), key in self.top_rules(top):
+            table, chain, pos, cond, target = key
+            print("%12.1f %14.1f  -t %s -A %s #%d %s -j %s"
+                  % (pps, bps, table, chain, pos + 1, cond, target))
+        print('')
+
+
+def sample(interval, top=SAMPLE_TOP, window=SAMPLE_WINDOW, count=None):
+    """Print the hottest chains and rules every interval seconds."""
+    sampler = RuleSampler(window)
+    taken = 0
+    while count is None or taken < count:
+        start = time.time()
+        sampler.add(take_snapshot(IptablesParser().parse_command()), start)
+        taken += 1
+        if sampler.rates:
+            if sys.stdout.isatty():
+                sys.stdout.write('\033[H\033[J')
+            print(time.strftime('%Y-%m-%d %H:%M:%S'))
+            sampler.dump(top)
+            sys.stdout.flush()
+        time.sleep(max(0, interval - (time.time() - start)))
+
+
+def report(parser, args):
+    if args.cost:
+        analyze_rule_order(parser.all_chains.values(), args.top)
+    elif args.classify:
+        if args.classify == '-':
+            classify_packets(sys.stdin, parser.all_chains)
+        else:
+            with open(args.classify) as f:
+                classify_packets(f, parser.all_chains)
+    else:
+        parser.pretty_print()
 
 
 if __name__ == '__main__':
-    if len(sys.argv) == 2:
-        with open(sys.argv[1]) as f:
-            for line in f.readlines():
-                parse_line(line)
+    parser = argparse.ArgumentParser(
+        description='Print iptables-save -c dumps as a tree')
+    parser.add_argument('-s', '--sample', type=float, metavar='INTERVAL',
+                        help='dump the counters every INTERVAL seconds and '
+                        'print the hottest chains and rules')
+    parser.add_argument('-c', '--cost', action='store_true',
+                        help='estimate rule evaluations per packet and '
+                        'suggest semantics preserving reorders')
+    parser.add_argument('-k', '--classify', metavar='PACKET_FILE',
+                        help='print the path and verdict of the packets in '
+                        'PACKET_FILE (- for stdin), one "src=10.0.0.5 '
+                        'dst=10.0.1.3 proto=tcp dport=22 in=eth0 '
+                        'physdev_in=tap..." per line')
+    parser.add_argument('-H', '--host', action='append',
+                        help='dump HOST over ssh, may be repeated; hosts are '
+                        'dumped concurrently')
+    parser.add_argument('-n', '--top', type=int, default=SAMPLE_TOP)
+    parser.add_argument('-w', '--window', type=int, default=SAMPLE_WINDOW,
+                        help='samples averaged per rule')
+    parser.add_argument('dump_file', nargs='?',
+                        help='iptables-save -c output, default: run it')
+    args = parser.parse_args()
+    if args.sample:
+        sample(args.sample, args.top, args.window)
+    elif args.host:
+        for host, result in sorted(parse_hosts(args.host).items()):
+            print("# host %s" % host)
+            if isinstance(result, Exception):
+                print("Error: %s\n" % result)
+            else:
+                report(result, args)
+    elif args.dump_file:
+        with open(args.dump_file) as f:
+            report(IptablesParser().parse(f), args)
     else:
-        popen = subprocess.Popen("sudo iptables-save -c",
-                                 shell=True, stdout=subprocess.PIPE)
-        content = popen.stdout.readlines()
-        for line in content:
-            parse_line(line)
-    group_results()
-    for tbl in tables:
-        print("-t %s" % tbl)
-        for chain in tables[tbl]:
-            print("%s\t[%d:%d]" % (chain.name, chain.packet, chain.byte))
-            chain.pretty_print('  ')
-        print('')
+        report(IptablesParser().parse_command(), args)